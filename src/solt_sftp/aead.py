@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import struct
+
+from paramiko.ssh_exception import SSHException
+
+try:
+    from cryptography.exceptions import InvalidSignature, InvalidTag
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+try:
+    from cryptography.hazmat.primitives.poly1305 import Poly1305
+except ImportError:
+    Poly1305 = None
+
+
+class solt_aes_gcm(object):
+    """ aes128-gcm@openssh.com and aes256-gcm@openssh.com (RFC 5647). The
+    packet length is sent in clear as additional authenticated data, the
+    last 8 bytes of the 12 bytes IV count the packets.
+    """
+    block_size = 16
+    tag_size = 16
+
+    def __init__(self, key, iv):
+        self.aead = AESGCM(key)
+        self.fixed = iv[:4]
+        self.invocation = struct.unpack('>Q', iv[4:])[0]
+
+    def nonce(self):
+        nonce = self.fixed + struct.pack('>Q', self.invocation)
+        self.invocation = (self.invocation + 1) & 0xffffffffffffffff
+        return nonce
+
+    def encrypt(self, seqno, packet):
+        return packet[:4] + self.aead.encrypt(self.nonce(), packet[4:], packet[:4])
+
+    def decrypt_length(self, seqno, header):
+        return struct.unpack('>I', header)[0]
+
+    def decrypt(self, seqno, header, data):
+        try:
+            return self.aead.decrypt(self.nonce(), data, header)
+        except InvalidTag:
+            raise SSHException('Mismatched MAC')
+
+
+class solt_chacha20_poly1305(object):
+    """ chacha20-poly1305@openssh.com. The 64 bytes key holds the payload
+    key and the length key, both used with the sequence number as nonce.
+    The Poly1305 key is the first keystream block of the payload key, the
+    payload is encrypted from the second one.
+    """
+    block_size = 8
+    tag_size = 16
+
+    def __init__(self, key, iv):
+        self.main_key = key[:32]
+        self.header_key = key[32:]
+        self.backend = default_backend()
+
+    def cipher(self, key, seqno, counter):
+        # 64 bits block counter then 64 bits nonce, as in the original ChaCha20
+        nonce = struct.pack('<Q', counter) + struct.pack('>Q', seqno)
+        return Cipher(algorithms.ChaCha20(key, nonce), None, self.backend)
+
+    def poly1305(self, seqno, data):
+        poly = Poly1305(self.cipher(self.main_key, seqno, 0).encryptor().update(b'\0' * 32))
+        poly.update(data)
+        return poly
+
+    def encrypt(self, seqno, packet):
+        length = self.cipher(self.header_key, seqno, 0).encryptor().update(packet[:4])
+        payload = self.cipher(self.main_key, seqno, 1).encryptor().update(packet[4:])
+        return length + payload + self.poly1305(seqno, length + payload).finalize()
+
+    def decrypt_length(self, seqno, header):
+        return struct.unpack('>I', self.cipher(self.header_key, seqno, 0).decryptor().update(header))[0]
+
+    def decrypt(self, seqno, header, data):
+        payload, tag = data[:-self.tag_size], data[-self.tag_size:]
+        try:
+            self.poly1305(seqno, header + payload).verify(tag)
+        except InvalidSignature:
+            raise SSHException('Mismatched MAC')
+        return self.cipher(self.main_key, seqno, 1).decryptor().update(payload)
+
+
+def poly1305_supported():
+    return Poly1305 is not None and default_backend().poly1305_supported()
+
+
+# the AEAD ciphers available, preferred first, in the format of the
+# `sftp_wrapper` ciphers
+aead_ciphers = ()
+aead_cipher_info = {}
+if AESGCM is not None:
+    if poly1305_supported():
+        aead_ciphers += ('chacha20-poly1305@openssh.com',)
+        aead_cipher_info['chacha20-poly1305@openssh.com'] = {
+            'class': solt_chacha20_poly1305, 'block-size': 8, 'key-size': 64, 'iv-size': 0, 'aead': True}
+    aead_ciphers += ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com')
+    aead_cipher_info['aes128-gcm@openssh.com'] = {
+        'class': solt_aes_gcm, 'block-size': 16, 'key-size': 16, 'iv-size': 12, 'aead': True}
+    aead_cipher_info['aes256-gcm@openssh.com'] = {
+        'class': solt_aes_gcm, 'block-size': 16, 'key-size': 32, 'iv-size': 12, 'aead': True}
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+"""
+Micro benchmarks of the per packet costs of the transport, run it with
+`python benchmark.py`.
+"""
+
+import os
+import struct
+import timeit
+from hmac import HMAC
+
+from wrapper import sftp_wrapper
+
+
+def bench_mac(sizes=(64, 1024, 32768), number=20000):
+    """ Per packet MAC cost, keying a new HMAC per packet as paramiko does
+    against copying the HMAC keyed once per key exchange.
+    """
+    print '%-32s %8s %12s %12s' % ('mac', 'packet', 'rekeyed us', 'cached us')
+    for name in sftp_wrapper._preferred_macs:
+        digest_class = sftp_wrapper._mac_info[name]['class']
+        key = os.urandom(digest_class().digest_size)
+        seqno = struct.pack('>I', 1)
+        cached = HMAC(key, digestmod=digest_class)
+        for size in sizes:
+            packet = os.urandom(size)
+
+            def rekeyed():
+                HMAC(key, seqno + packet, digest_class).digest()
+
+            def copied():
+                mac = cached.copy()
+                mac.update(seqno)
+                mac.update(packet)
+                mac.digest()
+            print '%-32s %8d %12.2f %12.2f' % (name, size,
+                                               timeit.timeit(rekeyed, number=number) / number * 1e6,
+                                               timeit.timeit(copied, number=number) / number * 1e6)
+
+
+if __name__ == '__main__':
+    bench_mac()
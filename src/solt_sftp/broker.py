@@ -23,15 +23,24 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import base64
+import binascii
+import hashlib
 import logging
 import gevent
 
 import redis
+import time
 import uuid
 import os
+from collections import OrderedDict
+from gevent.event import Event
+from gevent.queue import LifoQueue
 redis.connection.socket = gevent.socket
 
 from config import config
+from executor import fs_executor
+from stats import stats
 
 REMOTE_END_CLOSED_SOCKET = 'Socket closed on remote end'
 FILE_DESCR_CLOSED_IN_ANOTHER_GREENLET = "Error while reading from socket: (9, 'File descriptor was closed in another greenlet')"
@@ -40,74 +49,321 @@ EXPECTED_CONNECTION_ERRORS = [REMOTE_END_CLOSED_SOCKET, FILE_DESCR_CLOSED_IN_ANO
 
 _logger = logging.getLogger(__name__)
 
+
+class solt_redis_pool(redis.BlockingConnectionPool):
+    """ Bounded pool of Redis connections, a greenlet needing one while all
+    of them are in use waits on a gevent queue for at most `timeout`
+    seconds. The waits are recorded in the stats as `redis.pool_wait` and
+    the ones giving up as `redis.pool_timeout`.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queue_class', LifoQueue)
+        super(solt_redis_pool, self).__init__(**kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            return super(solt_redis_pool, self).get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            stats.incr('redis.pool_timeout')
+            raise
+        finally:
+            stats.timing('redis.pool_wait', time.time() - start)
+
+
+def redis_connection_kwargs():
+    return {
+        'host': config.get('redis_host', 'localhost'),
+        'port': int(config.get('redis_port', 6379)),
+        'db': int(config.get('redis_dbindex', 1)),
+        'password': config.get('redis_pass', None),
+        'socket_connect_timeout': float(config.get('redis_connect_timeout', 2)) or None,
+    }
+
+
+def pooled_redis():
+    """ A Redis client on a bounded `solt_redis_pool` """
+    return redis.Redis(connection_pool=solt_redis_pool(
+        max_connections=int(config.get('redis_pool_size', 10)),
+        timeout=float(config.get('redis_pool_timeout', 5)) or None,
+        socket_timeout=float(config.get('redis_socket_timeout', 5)) or None,
+        **redis_connection_kwargs()))
+
+
+def key_fingerprints(user_name, user_ssh):
+    """ Decode the user ssh-keys once, the auth compares the SHA-256 of
+    the key blob offered by the client with a set lookup.
+    """
+    fingerprints = set()
+    for user_key in user_ssh:
+        try:
+            fingerprints.add(hashlib.sha256(base64.decodestring(user_key)).digest())
+        except binascii.Error:
+            _logger.warning("Invalid ssh-key ignored for user %s", user_name)
+    return frozenset(fingerprints)
+
+
+class solt_unknown_users(object):
+    """ The usernames missing in Redis, remembered for `ttl` seconds so a
+    scanner trying a lot of them does not cost a Redis lookup per attempt.
+    """
+    # bound of the unknown usernames remembered
+    size = 10000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # user_name -> expiration time, the oldest first
+        self.expirations = OrderedDict()
+
+    def __contains__(self, user_name):
+        expiration = self.expirations.get(user_name)
+        if expiration is None:
+            return False
+        if expiration < time.time():
+            del self.expirations[user_name]
+            return False
+        return True
+
+    def add(self, user_name):
+        if not self.ttl:
+            return
+        self.expirations.pop(user_name, None)
+        self.expirations[user_name] = time.time() + self.ttl
+        if len(self.expirations) > self.size:
+            self.expirations.popitem(last=False)
+
+    def discard(self, user_name):
+        self.expirations.pop(user_name, None)
+
+    def clear(self):
+        self.expirations.clear()
+
+
+def create_folders(root_folder, folders):
+    """ Blocking, to be run in the filesystem threads. """
+    for folder in folders:
+        real_path = '%s/%s' % (root_folder, folder)
+        if not os.path.exists(real_path):
+            try:
+                os.makedirs(real_path)
+            except OSError as e:
+                _logger.error("Can not create the folder %s: %s", real_path, e)
+
+
 class solt_broker(object):
+    # the producers increment this counter and store the changed username
+    # in the sorted set, scored by the new counter value, before publishing
+    # it, so the changes missed while disconnected from the channel are
+    # replayed instead of reloading all the users
+    version_key = 'solt_sftp:users:version'
+    changes_key = 'solt_sftp:users:changes'
+    # seconds between two attempts to subscribe again to the channel
+    reconnect_delay_max = 60
     
     def __init__(self, *args, **kwargs):
-        self.redis_conn = redis.Redis(config.get('redis_host', 'localhost'),
-                                 int(config.get('redis_port', 6379)), 
-                                 int(config.get('redis_dbindex', 1)), 
-                                 password=config.get('redis_pass', None))
+        self.redis_conn = pooled_redis()
+        # the subscriber blocks reading its own connection for good, out of
+        # the pool and without socket timeout
+        self.subscriber_conn = redis.Redis(connection_pool=redis.ConnectionPool(**redis_connection_kwargs()))
         self.channel = config.get('redis_channel', 'solt_sftp')
         self.root_folder = config.get('sftp_path','/opt/solt_sftp/files')
         
-        self.authorized_keys = {}
+        # with a cache size the users are loaded on their first login
+        # and only the most recently used ones are kept
+        self.user_cache_size = int(config.get('user_cache_size', 0))
+        self.user_cache_ttl = int(config.get('user_cache_ttl', 300))
+        self.authorized_keys = OrderedDict() if self.user_cache_size else {}
+        self.unknown_users = solt_unknown_users(int(config.get('unknown_user_ttl', 60)))
+        self.batch_size = int(config.get('redis_batch_size', 1000))
+        # set whenever a user record is stored or dropped
+        self.changed = Event()
         
-        self.sftp_user_ids = self.redis_conn.hgetall('solt_sftp:user')
-        if self.sftp_user_ids:
-            for user_name in self.sftp_user_ids:
-                self.on_channel_user_handle({'data':user_name})
-        else:
-            self.sftp_user_ids = []
+        self.sftp_user_ids = {}
+        # read before the users so no later change is missed
+        self.version = self.get_version()
+        if not self.user_cache_size:
+            self.sftp_user_ids = self.redis_conn.hgetall('solt_sftp:user') or {}
+            self.load_users()
         
-        self.subscriber = self.redis_conn.pubsub()
+        self.subscriber = self.subscriber_conn.pubsub()
         self.subscriber_greenlet = gevent.spawn(self.listener)
     
+    def load_users(self):
+        """ Load all the users, `batch_size` of them per Redis pipeline. The
+        missing folders are created afterwards in a background greenlet.
+        """
+        start = time.time()
+        user_names = list(self.sftp_user_ids)
+        folders = []
+        for i in range(0, len(user_names), self.batch_size):
+            batch = user_names[i:i + self.batch_size]
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for user_name in batch:
+                user_id = self.sftp_user_ids[user_name]
+                pipe.hgetall('solt_sftp:user:%s:data' % user_id)
+                pipe.smembers('solt_sftp:user:%s:keys' % user_id)
+            results = pipe.execute()
+            # the folders assigned to the users without one
+            pipe = self.redis_conn.pipeline(transaction=False)
+            for user_name, user_data, user_ssh in zip(batch, results[::2], results[1::2]):
+                folder = self.set_user(user_name, self.sftp_user_ids[user_name], user_data, user_ssh, pipe)
+                if folder:
+                    folders.append(folder)
+            pipe.execute()
+        elapsed = time.time() - start
+        _logger.info("Loaded %d users in %.2fs (%.0f users/s)", len(self.authorized_keys),
+                     elapsed, len(self.authorized_keys) / max(elapsed, 0.001))
+        gevent.spawn(fs_executor.call, 'user_folders', self.create_folders, folders)
+
     def on_channel_user_handle(self, message):
         user_name = message.get('data')
+        self.unknown_users.discard(user_name)
+        if self.user_cache_size:
+            # read again on the next login
+            if self.authorized_keys.pop(user_name, None):
+                self.changed.set()
+            return
+        self.load_user(user_name)
+
+    def load_user(self, user_name):
+        """ Read the user from Redis, return False when it does not exist. """
         if self.sftp_user_ids.get(user_name, False):
             user_id = self.sftp_user_ids[user_name]
         else:
             user_id = self.redis_conn.hget('solt_sftp:user', user_name)
-        user_key = 'solt_sftp:user:%s:data' % user_id
-        user_ssh_key = 'solt_sftp:user:%s:keys' % user_id
-        user_data = self.redis_conn.hgetall(user_key)
-        
-        if user_data:
-            if user_data.get('folder', False):
-                folder = user_data.get('folder')
-            else:
-                folder = uuid.uuid4().hex
-                self.redis_conn.hset(user_key, 'folder', folder)
-            real_path = '%s/%s'%(self.root_folder,folder)
-            if not os.path.exists(real_path):
-                os.makedirs(real_path)
-            user_ssh = self.redis_conn.smembers(user_ssh_key)
-            
+            if not user_id:
+                return False
+            if not self.user_cache_size:
+                self.sftp_user_ids[user_name] = user_id
+        pipe = self.redis_conn.pipeline(transaction=False)
+        pipe.hgetall('solt_sftp:user:%s:data' % user_id)
+        pipe.smembers('solt_sftp:user:%s:keys' % user_id)
+        user_data, user_ssh = pipe.execute()
+        folder = self.set_user(user_name, user_id, user_data, user_ssh, self.redis_conn)
+        if folder:
             _logger.info("Add user %s", user_data.get('name'))
-            self.authorized_keys[user_name] = {
-                'id': user_id,
-                'name': user_data.get('name'),
-                'ssh-keys': tuple(user_ssh),
-                'active': user_data.get('active'),
-                'folder': folder,
-            }
-        
+            fs_executor.call('user_folders', self.create_folders, [folder])
+        return bool(folder)
+
+    def get_user(self, user_name):
+        """ The user record, read from Redis when missing or expired. """
+        user_cfg = self.authorized_keys.get(user_name)
+        if user_cfg and self.user_cache_size:
+            del self.authorized_keys[user_name]
+            if user_cfg['expires'] > time.time():
+                # keep the most recently used users at the end
+                self.authorized_keys[user_name] = user_cfg
+                return user_cfg
+            user_cfg = None
+        if not user_cfg:
+            self.channel_user_update(user_name)
+            user_cfg = self.authorized_keys.get(user_name)
+        return user_cfg
+
+    def set_user(self, user_name, user_id, user_data, user_ssh, redis_conn):
+        """ Store the user record, a new folder is saved to Redis through
+        `redis_conn` when the user has none. Return the user folder.
+        """
+        if not user_data:
+            return False
+        if user_data.get('folder', False):
+            folder = user_data.get('folder')
+        else:
+            folder = uuid.uuid4().hex
+            redis_conn.hset('solt_sftp:user:%s:data' % user_id, 'folder', folder)
+        self.authorized_keys[user_name] = {
+            'id': user_id,
+            'name': user_data.get('name'),
+            'ssh-keys': tuple(user_ssh),
+            'key-fingerprints': key_fingerprints(user_name, user_ssh),
+            'active': user_data.get('active'),
+            'folder': folder,
+        }
+        self.changed.set()
+        if self.user_cache_size:
+            self.authorized_keys[user_name]['expires'] = time.time() + self.user_cache_ttl
+            while len(self.authorized_keys) > self.user_cache_size:
+                self.authorized_keys.popitem(last=False)
+        return folder
+
+    def create_folders(self, folders):
+        """ Blocking, to be run in the filesystem threads. """
+        create_folders(self.root_folder, folders)
+
     def listener(self):
-        self.subscriber.subscribe(self.channel)
+        delay = 1
+        first = True
         try:
-            try:
-                while True:
+            while True:
+                try:
+                    self.subscriber.subscribe(self.channel)
+                    # redis-py itself reconnects once when the connection
+                    # drops while listening, the changes meanwhile are lost
+                    self.subscriber.connection.register_connect_callback(
+                        lambda connection: gevent.spawn(self.catch_up))
+                    self.catch_up(first)
+                    first = False
+                    delay = 1
                     for msg in self.subscriber.listen():
+                        if msg.get('type') != 'message':
+                            continue
                         _logger.info('Message received in Redis channel for user management: %s', msg)
                         self.on_channel_user_handle(msg)
-            except redis.ConnectionError, e:
-                if e.message not in EXPECTED_CONNECTION_ERRORS:
-                    _logger.info('Caught `%s`, will quit now', e.message)
-                    raise
+                except redis.RedisError, e:
+                    # also the timeouts and the errors replied by a server
+                    # in failover, like READONLY
+                    if e.message not in EXPECTED_CONNECTION_ERRORS:
+                        _logger.warning('Lost the Redis channel for user management (%s), subscribing again in %ds',
+                                        e.message, delay)
+                    self.subscriber.reset()
+                    gevent.sleep(delay)
+                    delay = min(delay * 2, self.reconnect_delay_max)
         except KeyboardInterrupt:
             pass
-        
+
+    def get_version(self):
+        return int(self.redis_conn.get(self.version_key) or 0)
+
+    def catch_up(self, first=False):
+        """ Apply the user changes made since the last subscription to the
+        channel, all the users are read again when Redis has no change log
+        covering them.
+        """
+        version = self.get_version()
+        if version and version >= self.version:
+            user_names = self.redis_conn.zrangebyscore(self.changes_key, '(%d' % self.version, version)
+            if user_names:
+                _logger.info('Replaying %d user changes missed since version %d', len(user_names), self.version)
+            for user_name in user_names:
+                self.on_channel_user_handle({'data': user_name})
+        elif version or not first:
+            _logger.warning('No user change log since version %d, reloading all the users', self.version)
+            self.reload_users()
+        self.version = version
+
+    def reload_users(self):
+        self.unknown_users.clear()
+        if self.user_cache_size:
+            self.authorized_keys.clear()
+            return
+        self.sftp_user_ids = self.redis_conn.hgetall('solt_sftp:user') or {}
+        for user_name in set(self.authorized_keys).difference(self.sftp_user_ids):
+            del self.authorized_keys[user_name]
+            self.changed.set()
+        self.load_users()
+
     def channel_user_update(self, user_name):
-        user_id = self.redis_conn.hget('solt_sftp:user', user_name)
-        if user_id:
-            self.on_channel_user_handle({'data':user_name})
\ No newline at end of file
+        if self.is_unknown_user(user_name):
+            return
+        if not self.load_user(user_name):
+            self.add_unknown_user(user_name)
+
+    def is_unknown_user(self, user_name):
+        return user_name in self.unknown_users
+
+    def add_unknown_user(self, user_name):
+        """ Remember a username missing in Redis for `unknown_user_ttl`
+        seconds, a message in the user channel forgets it right away.
+        """
+        self.unknown_users.add(user_name)
\ No newline at end of file
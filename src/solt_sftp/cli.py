@@ -23,6 +23,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from gevent import monkey
+# paramiko runs the subsystem handlers in threads that wait on threading
+# primitives, they have to be greenlets sharing the hub with the sessions
+monkey.patch_thread()
+
 from paramiko.rsakey import RSAKey
 
 import os
@@ -31,6 +36,7 @@ import logging
 
 from config import config
 from logger import init_logger
+from prefork import solt_prefork
 from gevent.server import StreamServer
 
 
@@ -59,6 +65,13 @@ def setup_pid_file():
         pidtext = "%d" % (os.getpid())
         fd.write(pidtext)
         fd.close()
+
+def load_session_handler():
+    """ Import the session handler, this creates the Redis broker and loads
+    the server key so in prefork mode it is only called in the workers.
+    """
+    from server import handle_sftp_session
+    return handle_sftp_session
         
 
 def main():
@@ -69,8 +82,12 @@ def main():
     init_logger()
     setup_pid_file()
     
-    from server import handle_sftp_session
-    server = StreamServer(('0.0.0.0', int(config.options.get('sftp_port',2200))), handle_sftp_session)
+    address = ('0.0.0.0', int(config.options.get('sftp_port',2200)))
+    if int(config['workers']) > 0:
+        rc = solt_prefork(address, load_session_handler).run()
+        sys.exit(rc)
+
+    server = StreamServer(address, load_session_handler())
     _logger.info('Solt SFTP server is running and waiting for connections...')
     try:
         server.serve_forever()
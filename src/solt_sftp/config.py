@@ -43,7 +43,7 @@ class config_parser(object):
         group.add_option("-c", "--config", dest="config", help="specify alternate config file")
         group.add_option("--pidfile", dest="pidfile", default=False, help="file where the server pid will be stored")
         group.add_option("--sftp-path", dest="sftp_path", help="where the sftp server files will be stored")
-        group.add_option("--sftp-key", dest="sftp_key", help="where is the sftp server private key")
+        group.add_option("--sftp-key", dest="sftp_key", help="where is the sftp server private key, several comma separated keys of different types may be given")
         group.add_option("--sftp-port", dest="sftp_port", type="int", default=220, help="in what port the sftp server will be listen")
         parser.add_option_group(group)
 
@@ -68,6 +68,16 @@ class config_parser(object):
                          help="specify the database port", type="int")
         group.add_option("--redis_dbindex", dest="redis_dbindex", type='int', default=1,
                          help="specify the redis database index")
+        group.add_option("--redis_batch_size", dest="redis_batch_size", type='int', default=1000,
+                         help="number of users loaded per Redis pipeline at startup")
+        group.add_option("--redis_pool_size", dest="redis_pool_size", type='int', default=10,
+                         help="maximum number of Redis connections per process")
+        group.add_option("--redis_pool_timeout", dest="redis_pool_timeout", type='float', default=5,
+                         help="seconds waiting for a free Redis connection, 0 waits forever")
+        group.add_option("--redis_socket_timeout", dest="redis_socket_timeout", type='float', default=5,
+                         help="seconds waiting for a Redis reply, 0 waits forever")
+        group.add_option("--redis_connect_timeout", dest="redis_connect_timeout", type='float', default=2,
+                         help="seconds waiting to connect to Redis, 0 waits forever")
         parser.add_option_group(group)
 
         # Advanced options
@@ -77,13 +87,13 @@ class config_parser(object):
                          help="Specify the number of workers, 0 disable prefork mode.",
                          type="int")
         group.add_option("--limit-memory-soft", dest="limit_memory_soft", default=640 * 1024 * 1024,
-                         help="Maximum allowed virtual memory per worker, when reached the worker be reset after the current request (default 671088640 aka 640MB).",
+                         help="Maximum allowed resident memory per worker, when reached the worker is replaced once its sessions are over (default 671088640 aka 640MB).",
                          type="int")
         group.add_option("--limit-memory-hard", dest="limit_memory_hard", default=768 * 1024 * 1024,
                          help="Maximum allowed virtual memory per worker, when reached, any memory allocation will fail (default 805306368 aka 768MB).",
                          type="int")
         group.add_option("--limit-time-cpu", dest="limit_time_cpu", default=60,
-                         help="Maximum allowed CPU time per request (default 60).",
+                         help="Maximum time a single request may keep the worker busy, the worker is then replaced once its sessions are over (default 60).",
                          type="int")
         group.add_option("--limit-time-real", dest="limit_time_real", default=120,
                          help="Maximum allowed Real time per request (default 120).",
@@ -93,6 +103,45 @@ class config_parser(object):
                          type="int")
         parser.add_option_group(group)
 
+        group = optparse.OptionGroup(parser, "Performance options")
+        group.add_option("--fs-threads", dest="fs_threads", default=8,
+                         help="Number of threads per worker running the blocking filesystem calls, 0 runs them in the gevent hub (default 8).",
+                         type="int")
+        group.add_option("--sftp-requests", dest="sftp_requests", default=32,
+                         help="Maximum number of requests per SFTP session processed at the same time (default 32).",
+                         type="int")
+        group.add_option("--readahead-size", dest="readahead_size", default=262144,
+                         help="Bytes per file handle read ahead of a sequential download, 0 disable it (default 262144).",
+                         type="int")
+        group.add_option("--write-buffer-size", dest="write_buffer_size", default=262144,
+                         help="Bytes per file handle of contiguous uploaded data gathered into a single write, 0 disable it (default 262144).",
+                         type="int")
+        group.add_option("--kex-processes", dest="kex_processes", default=0,
+                         help="Number of processes per worker computing the key exchanges and host key signatures, 0 computes them in the gevent hub (default 0).",
+                         type="int")
+        group.add_option("--kex-queue", dest="kex_queue", default=32,
+                         help="Number of key exchanges per worker waiting for a free kex process, the handshakes beyond it are refused (default 32).",
+                         type="int")
+        group.add_option("--kex-dh-pool-size", dest="kex_dh_pool_size", default=16,
+                         help="Number of ephemeral Diffie-Hellman keys per group computed ahead of the handshakes by the kex processes, 0 disable it (default 16).",
+                         type="int")
+        group.add_option("--kex-dh-pool-rate", dest="kex_dh_pool_rate", default=10,
+                         help="Maximum number of ephemeral Diffie-Hellman keys per group computed per second, 0 does not limit it (default 10).",
+                         type="float")
+        group.add_option("--unknown-user-ttl", dest="unknown_user_ttl", default=60,
+                         help="Seconds an username missing in Redis is not looked up again, unless a message for it arrives in the users channel, 0 disable it (default 60).",
+                         type="int")
+        group.add_option("--user-cache-size", dest="user_cache_size", default=0,
+                         help="Load the users from Redis on their first login into a cache of this many users instead of loading all of them at startup, 0 disable it (default 0).",
+                         type="int")
+        group.add_option("--user-cache-ttl", dest="user_cache_ttl", default=300,
+                         help="Seconds a cached user is kept before being read again from Redis, only with --user-cache-size (default 300).",
+                         type="int")
+        group.add_option("--stats-interval", dest="stats_interval", default=300,
+                         help="Seconds between two dumps of the per worker statistics in the log, 0 disable them (default 300).",
+                         type="int")
+        parser.add_option_group(group)
+
         # Copy all optparse options (i.e. MyOption) into self.options.
         
         for group in parser.option_groups:
@@ -120,7 +169,12 @@ class config_parser(object):
             'redis_dbindex', 'redis_pass', 'redis_host', 'redis_port', 
             'logfile', 'pidfile', 'sftp_path', 'sftp_key',
             'workers', 'limit_memory_hard', 'limit_memory_soft', 
-            'limit_time_cpu', 'limit_time_real', 'limit_request'
+            'limit_time_cpu', 'limit_time_real', 'limit_request',
+            'fs_threads', 'stats_interval', 'unknown_user_ttl', 'redis_batch_size',
+            'user_cache_size', 'user_cache_ttl', 'redis_pool_size', 'redis_pool_timeout',
+            'redis_socket_timeout', 'redis_connect_timeout', 'kex_processes', 'kex_queue',
+            'kex_dh_pool_size', 'kex_dh_pool_rate', 'sftp_requests', 'readahead_size',
+            'write_buffer_size',
         ]
         
         for arg in keys:
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import cPickle
+import logging
+import os
+import resource
+import signal
+import socket
+import struct
+import time
+
+import gevent.socket
+from gevent import Timeout
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
+from paramiko.ssh_exception import SSHException
+
+from config import config
+from stats import stats
+
+_logger = logging.getLogger(__name__)
+
+
+class solt_executor(object):
+    """ Runs blocking filesystem calls in a gevent thread pool, so a slow
+    disk only blocks the session waiting for it instead of the whole hub.
+
+    With a size of 0 the calls run inline on the hub.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pool = ThreadPool(size) if size else None
+
+    def call(self, op, func, *args):
+        """ Run `func(*args)` and return its result, `op` names the
+        operation in the stats: `fs.<op>` is the total time and
+        `fs.<op>.queue` the time spent waiting for a free thread.
+        """
+        submitted = time.time()
+        if self.pool is None:
+            try:
+                return func(*args)
+            finally:
+                stats.timing('fs.%s' % op, time.time() - submitted)
+        started = []
+
+        def run():
+            started.append(time.time())
+            return func(*args)
+        try:
+            return self.pool.apply(run)
+        finally:
+            if started:
+                stats.timing('fs.%s.queue' % op, started[0] - submitted)
+            stats.timing('fs.%s' % op, time.time() - submitted)
+
+
+
+def _process_init():
+    # the worker signal handlers are not meant for the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _send_object(sock, obj):
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def _recv_object(sock):
+    size, = struct.unpack('>I', _recv_exactly(sock, 4))
+    return cPickle.loads(_recv_exactly(sock, size))
+
+
+def _process_loop(sock):
+    """ The body of a pool process: run the calls sent by the worker one
+    at a time until it closes the socket.
+    """
+    _process_init()
+    while True:
+        try:
+            func, args = _recv_object(sock)
+        except EOFError:
+            return
+        started = time.time()
+        try:
+            result = (True, started, func(*args))
+        except Exception as e:
+            result = (False, started, e)
+        _send_object(sock, result)
+
+
+class solt_process_executor(object):
+    """ Runs CPU bound calls, like the key exchange math, in a pool of
+    forked processes so the hub keeps serving the established sessions
+    while they compute. Each process runs one call at a time and talks to
+    the worker through a socket, waited on by the calling greenlet.
+
+    At most `size` calls run and `queue` wait, the calls beyond them are
+    refused. With a size of 0 the calls run inline on the hub.
+    """
+    timeout = 30
+
+    def __init__(self, size, queue, prefix):
+        self.size = size
+        self.queue = queue
+        self.prefix = prefix
+        self.pending = 0
+        # forked on first use, in prefork mode that is in each worker
+        self.idle = None
+
+    def start(self):
+        self.idle = Queue()
+        for i in range(self.size):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        parent, child = socket.socketpair()
+        pid = os.fork()
+        if not pid:
+            parent.close()
+            # the listening and session sockets of the worker must not be
+            # kept open by the pool, a closed session would stay half open
+            fd = child.fileno()
+            max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            if max_fd == resource.RLIM_INFINITY:
+                max_fd = 65536
+            os.closerange(3, fd)
+            os.closerange(fd + 1, max_fd)
+            try:
+                _process_loop(child)
+            finally:
+                os._exit(0)
+        child.close()
+        return pid, gevent.socket.socket(_sock=parent)
+
+    def kill(self, process):
+        pid, sock = process
+        sock.close()
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def call(self, op, func, *args):
+        """ Run `func(*args)` and return its result, the function, its
+        arguments and its result must be picklable. `<prefix>.<op>` is the
+        total time and `<prefix>.<op>.queue` the time spent waiting for a
+        free process.
+        """
+        submitted = time.time()
+        if not self.size:
+            try:
+                return func(*args)
+            finally:
+                stats.timing('%s.%s' % (self.prefix, op), time.time() - submitted)
+        if self.pending >= self.size + self.queue:
+            stats.incr('%s.rejected' % self.prefix)
+            raise SSHException('Too many %s calls in progress' % self.prefix)
+        if self.idle is None:
+            self.start()
+        self.pending += 1
+        try:
+            process = self.idle.get()
+            try:
+                with Timeout(self.timeout, SSHException('%s call timed out' % self.prefix)):
+                    _send_object(process[1], (func, args))
+                    ok, started, result = _recv_object(process[1])
+            except BaseException:
+                # a dead, stuck or interrupted process is replaced
+                self.kill(process)
+                process = self.spawn()
+                raise
+            finally:
+                self.idle.put(process)
+        finally:
+            self.pending -= 1
+        stats.timing('%s.%s.queue' % (self.prefix, op), started - submitted)
+        stats.timing('%s.%s' % (self.prefix, op), time.time() - submitted)
+        if not ok:
+            raise result
+        return result
+
+fs_executor = solt_executor(int(config['fs_threads']))
+kex_executor = solt_process_executor(int(config['kex_processes']), int(config['kex_queue']), 'handshake')
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+from collections import deque
+from hashlib import sha256
+
+import gevent
+from gevent.event import Event
+from paramiko import util
+from paramiko.kex_gex import KexGex, c_MSG_KEXDH_GEX_REPLY
+from paramiko.kex_group1 import KexGroup1, _MSG_KEXDH_INIT, c_MSG_KEXDH_REPLY
+from paramiko.kex_group14 import KexGroup14
+from paramiko.message import Message
+from paramiko.py3compat import byte_chr
+from paramiko.ssh_exception import SSHException
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:
+    ec = None
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+except ImportError:
+    X25519PrivateKey = None
+
+from config import config
+from executor import kex_executor
+from stats import stats
+
+_MSG_KEX_ECDH_INIT, _MSG_KEX_ECDH_REPLY = range(30, 32)
+c_MSG_KEX_ECDH_INIT, c_MSG_KEX_ECDH_REPLY = [byte_chr(c) for c in range(30, 32)]
+
+
+def dh_compute(g, x, e, p):
+    """ Our public value and the shared secret of a Diffie-Hellman exchange """
+    return pow(g, x, p), pow(e, x, p)
+
+
+def sign_ssh_data(key, data):
+    # the Message does not pickle, the signature crosses the kex executor as bytes
+    return key.sign_ssh_data(data).asbytes()
+
+
+class solt_dh_pool(object):
+    """ Ephemeral Diffie-Hellman pairs (x, g^x mod p) of a group computed
+    ahead of the handshakes, at most `rate` per second or without limit
+    when it is 0, so a handshake only computes the shared secret. Each pair
+    is popped by a single handshake and never handed out again.
+
+    The pool starts filling on the first handshake of its group, in
+    prefork mode that is after the fork so no two workers share a pair.
+    Without kex processes it stays empty, the modexps would run on the hub.
+    """
+    # seconds between two checks while handshakes wait for a kex process
+    busy_delay = 0.1
+
+    def __init__(self, kex_class, size, rate):
+        self.kex_class = kex_class
+        self.size = size
+        self.rate = rate
+        # seconds between two pairs
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.pairs = deque()
+        self.taken = Event()
+        self.greenlet = None
+
+    def take(self):
+        """ A pair (x, f) or None when the pool is empty """
+        if not self.size or not kex_executor.size:
+            return None
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.refill)
+        self.taken.set()
+        if not self.pairs:
+            stats.incr('dh_pool.%s.miss' % self.kex_class.name)
+            return None
+        stats.incr('dh_pool.%s.hit' % self.kex_class.name)
+        return self.pairs.popleft()
+
+    def refill(self):
+        while True:
+            while len(self.pairs) < self.size:
+                # the handshakes waiting for a kex process go first
+                if kex_executor.pending:
+                    gevent.sleep(max(self.interval, self.busy_delay))
+                    continue
+                started = time.time()
+                kex = self.kex_class(None)
+                kex._generate_x()
+                try:
+                    self.pairs.append((kex.x, kex_executor.call('dh_pool', pow, kex.G, kex.x, kex.P)))
+                except SSHException:
+                    pass
+                gevent.sleep(max(0, self.interval - (time.time() - started)))
+            self.taken.clear()
+            self.taken.wait()
+
+
+dh_pools = {}
+
+
+def dh_pool(kex_class):
+    pool = dh_pools.get(kex_class.name)
+    if pool is None:
+        pool = dh_pools[kex_class.name] = solt_dh_pool(
+            kex_class, int(config['kex_dh_pool_size']), float(config['kex_dh_pool_rate']))
+    return pool
+
+
+class solt_kex_group1(KexGroup1):
+    """ diffie-hellman-group1-sha1 computing the server side modexps and
+    the host key signature in the kex executor. The ephemeral pair comes
+    from the `solt_dh_pool` of the group when available, otherwise both
+    modexps run in one call.
+    """
+
+    def start_kex(self):
+        if not self.transport.server_mode:
+            return super(solt_kex_group1, self).start_kex()
+        pair = dh_pool(type(self)).take()
+        if pair is None:
+            self._generate_x()
+            self.f = None
+        else:
+            self.x, self.f = pair
+        self.transport._expect_packet(_MSG_KEXDH_INIT)
+
+    def _parse_kexdh_init(self, m):
+        # server mode
+        self.e = m.get_mpint()
+        if (self.e < 1) or (self.e > self.P - 1):
+            raise SSHException('Client kex "e" is out of range')
+        if self.f is None:
+            self.f, K = kex_executor.call('dh', dh_compute, self.G, self.x, self.e, self.P)
+        else:
+            K = kex_executor.call('dh_shared', pow, self.e, self.x, self.P)
+        key = self.transport.get_server_key().asbytes()
+        # H of (V_C || V_S || I_C || I_S || K_S || e || f || K)
+        hm = Message()
+        hm.add(self.transport.remote_version, self.transport.local_version,
+               self.transport.remote_kex_init, self.transport.local_kex_init)
+        hm.add_string(key)
+        hm.add_mpint(self.e)
+        hm.add_mpint(self.f)
+        hm.add_mpint(K)
+        H = self.hash_algo(hm.asbytes()).digest()
+        self.transport._set_K_H(K, H)
+        sig = kex_executor.call('sign', sign_ssh_data, self.transport.get_server_key(), H)
+        m = Message()
+        m.add_byte(c_MSG_KEXDH_REPLY)
+        m.add_string(key)
+        m.add_mpint(self.f)
+        m.add_string(sig)
+        self.transport._send_message(m)
+        self.transport._activate_outbound()
+
+
+class solt_kex_group14(solt_kex_group1):
+    P = KexGroup14.P
+    G = KexGroup14.G
+    name = KexGroup14.name
+
+
+class solt_kex_gex(KexGex):
+    """ diffie-hellman-group-exchange-sha1 computing the server side math
+    in the kex executor like `solt_kex_group1`.
+    """
+
+    def _parse_kexdh_gex_init(self, m):
+        self.e = m.get_mpint()
+        if (self.e < 1) or (self.e > self.p - 1):
+            raise SSHException('Client kex "e" is out of range')
+        self._generate_x()
+        self.f, K = kex_executor.call('dh', dh_compute, self.g, self.x, self.e, self.p)
+        key = self.transport.get_server_key().asbytes()
+        # H of (V_C || V_S || I_C || I_S || K_S || min || n || max || p || g || e || f || K)
+        hm = Message()
+        hm.add(self.transport.remote_version, self.transport.local_version,
+               self.transport.remote_kex_init, self.transport.local_kex_init,
+               key)
+        if not self.old_style:
+            hm.add_int(self.min_bits)
+        hm.add_int(self.preferred_bits)
+        if not self.old_style:
+            hm.add_int(self.max_bits)
+        hm.add_mpint(self.p)
+        hm.add_mpint(self.g)
+        hm.add_mpint(self.e)
+        hm.add_mpint(self.f)
+        hm.add_mpint(K)
+        H = self.hash_algo(hm.asbytes()).digest()
+        self.transport._set_K_H(K, H)
+        sig = kex_executor.call('sign', sign_ssh_data, self.transport.get_server_key(), H)
+        m = Message()
+        m.add_byte(c_MSG_KEXDH_GEX_REPLY)
+        m.add_string(key)
+        m.add_mpint(self.f)
+        m.add_string(sig)
+        self.transport._send_message(m)
+        self.transport._activate_outbound()
+
+
+class solt_kex_ecdh(object):
+    """ Elliptic curve Diffie-Hellman key exchange (RFC 5656, RFC 8731), the
+    subclasses provide the curve. Both sides send an ephemeral public key
+    and the server signs the exchange hash, one scalar multiplication per
+    side instead of the 2048 bits modexp of diffie-hellman-group14.
+    """
+    hash_algo = sha256
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.private_key = None
+        self.Q = None
+
+    def start_kex(self):
+        self.generate()
+        if self.transport.server_mode:
+            self.transport._expect_packet(_MSG_KEX_ECDH_INIT)
+            return
+        m = Message()
+        m.add_byte(c_MSG_KEX_ECDH_INIT)
+        m.add_string(self.Q)
+        self.transport._send_message(m)
+        self.transport._expect_packet(_MSG_KEX_ECDH_REPLY)
+
+    def parse_next(self, ptype, m):
+        if self.transport.server_mode and (ptype == _MSG_KEX_ECDH_INIT):
+            return self._parse_kex_ecdh_init(m)
+        elif not self.transport.server_mode and (ptype == _MSG_KEX_ECDH_REPLY):
+            return self._parse_kex_ecdh_reply(m)
+        raise SSHException('%s asked to handle packet type %d' % (self.name, ptype))
+
+    def exchange_hash(self, host_key, Q_C, Q_S, K):
+        # H of (V_C || V_S || I_C || I_S || K_S || Q_C || Q_S || K)
+        t = self.transport
+        hm = Message()
+        if t.server_mode:
+            hm.add(t.remote_version, t.local_version, t.remote_kex_init, t.local_kex_init)
+        else:
+            hm.add(t.local_version, t.remote_version, t.local_kex_init, t.remote_kex_init)
+        hm.add_string(host_key)
+        hm.add_string(Q_C)
+        hm.add_string(Q_S)
+        hm.add_mpint(K)
+        return self.hash_algo(hm.asbytes()).digest()
+
+    def _parse_kex_ecdh_init(self, m):
+        # server mode
+        Q_C = m.get_string()
+        K = self.shared_secret(Q_C)
+        key = self.transport.get_server_key().asbytes()
+        H = self.exchange_hash(key, Q_C, self.Q, K)
+        self.transport._set_K_H(K, H)
+        sig = kex_executor.call('sign', sign_ssh_data, self.transport.get_server_key(), H)
+        m = Message()
+        m.add_byte(c_MSG_KEX_ECDH_REPLY)
+        m.add_string(key)
+        m.add_string(self.Q)
+        m.add_string(sig)
+        self.transport._send_message(m)
+        self.transport._activate_outbound()
+
+    def _parse_kex_ecdh_reply(self, m):
+        # client mode
+        host_key = m.get_string()
+        Q_S = m.get_string()
+        sig = m.get_binary()
+        K = self.shared_secret(Q_S)
+        self.transport._set_K_H(K, self.exchange_hash(host_key, self.Q, Q_S, K))
+        self.transport._verify_key(host_key, sig)
+        self.transport._activate_outbound()
+
+
+class solt_kex_curve25519(solt_kex_ecdh):
+    name = 'curve25519-sha256'
+
+    def generate(self):
+        self.private_key = X25519PrivateKey.generate()
+        self.Q = self.private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+    def shared_secret(self, peer_Q):
+        try:
+            shared = self.private_key.exchange(X25519PublicKey.from_public_bytes(peer_Q))
+        except ValueError:
+            raise SSHException('Invalid %s public key' % self.name)
+        if shared == b'\0' * 32:
+            raise SSHException('Invalid %s shared secret' % self.name)
+        return util.inflate_long(shared, True)
+
+
+class solt_kex_nistp256(solt_kex_ecdh):
+    name = 'ecdh-sha2-nistp256'
+    curve = ec.SECP256R1() if ec is not None else None
+
+    def generate(self):
+        self.private_key = ec.generate_private_key(self.curve, default_backend())
+        self.Q = self.private_key.public_key().public_bytes(Encoding.X962, PublicFormat.UncompressedPoint)
+
+    def shared_secret(self, peer_Q):
+        try:
+            peer_key = ec.EllipticCurvePublicKey.from_encoded_point(self.curve, peer_Q)
+            shared = self.private_key.exchange(ec.ECDH(), peer_key)
+        except ValueError:
+            raise SSHException('Invalid %s public key' % self.name)
+        return util.inflate_long(shared, True)
+
+
+# the elliptic curve key exchanges available, preferred first, in the
+# format of the `sftp_wrapper` kex
+ecdh_kex = ()
+ecdh_kex_info = {}
+if X25519PrivateKey is not None and default_backend().x25519_supported():
+    ecdh_kex += ('curve25519-sha256', 'curve25519-sha256@libssh.org')
+    ecdh_kex_info['curve25519-sha256'] = solt_kex_curve25519
+    ecdh_kex_info['curve25519-sha256@libssh.org'] = solt_kex_curve25519
+if ec is not None:
+    ecdh_kex += ('ecdh-sha2-nistp256',)
+    ecdh_kex_info['ecdh-sha2-nistp256'] = solt_kex_nistp256
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from hashlib import sha256, sha512
+
+from Crypto.PublicKey import RSA
+
+from paramiko import util
+from paramiko.common import max_byte, zero_byte, one_byte
+from paramiko.dsskey import DSSKey
+from paramiko.ecdsakey import ECDSAKey
+from paramiko.message import Message
+from paramiko.pkey import PKey
+from paramiko.py3compat import long
+from paramiko.rsakey import RSAKey
+from paramiko.ssh_exception import SSHException
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+    from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
+except ImportError:
+    Ed25519PrivateKey = None
+try:
+    from cryptography.hazmat.primitives.serialization import load_ssh_private_key
+except ImportError:
+    load_ssh_private_key = None
+
+
+class solt_rsa_sha2_key(RSAKey):
+    """ An RSA key signing with SHA-256 or SHA-512 instead of SHA-1 (RFC 8332).
+    The public blob stays the `ssh-rsa` one, only the signature algorithm
+    changes, so the same key file serves the three algorithms. The
+    subclasses provide the digest.
+    """
+    name = None
+    digest = None
+    digest_info = None
+
+    @classmethod
+    def from_rsa_key(cls, key):
+        obj = cls(vals=(key.e, key.n))
+        obj.d = key.d
+        obj.p = key.p
+        obj.q = key.q
+        return obj
+
+    def get_name(self):
+        return self.name
+
+    def sign_ssh_data(self, data):
+        key = RSA.construct((long(self.n), long(self.e), long(self.d)))
+        sig = util.deflate_long(key.sign(self._pkcs1imify(self.digest(data).digest()), bytes())[0], 0)
+        # the signature is padded to the size of the modulus
+        sig = zero_byte * (len(util.deflate_long(self.n, 0)) - len(sig)) + sig
+        m = Message()
+        m.add_string(self.name)
+        m.add_string(sig)
+        return m
+
+    def verify_ssh_sig(self, data, msg):
+        if msg.get_text() != self.name:
+            return False
+        sig = util.inflate_long(msg.get_binary(), True)
+        hash_obj = util.inflate_long(self._pkcs1imify(self.digest(data).digest()), True)
+        key = RSA.construct((long(self.n), long(self.e)))
+        return key.verify(hash_obj, (sig,))
+
+    def _pkcs1imify(self, data):
+        size = len(util.deflate_long(self.n, 0))
+        filler = max_byte * (size - len(self.digest_info) - len(data) - 3)
+        return zero_byte + one_byte + filler + zero_byte + self.digest_info + data
+
+
+class solt_rsa_sha2_256_key(solt_rsa_sha2_key):
+    name = 'rsa-sha2-256'
+    digest = sha256
+    digest_info = b'\x30\x31\x30\x0d\x06\x09\x60\x86\x48\x01\x65\x03\x04\x02\x01\x05\x00\x04\x20'
+
+
+class solt_rsa_sha2_512_key(solt_rsa_sha2_key):
+    name = 'rsa-sha2-512'
+    digest = sha512
+    digest_info = b'\x30\x51\x30\x0d\x06\x09\x60\x86\x48\x01\x65\x03\x04\x02\x03\x05\x00\x04\x40'
+
+
+class solt_ed25519_key(PKey):
+    """ An ssh-ed25519 key (RFC 8709). Signing is a fraction of the cost of
+    a 2048 bits RSA signature, which is paid on every handshake.
+    """
+    name = 'ssh-ed25519'
+
+    def __init__(self, msg=None, data=None, private_key=None):
+        self.private_key = private_key
+        if private_key is not None:
+            self.public_bytes = private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+            return
+        if (msg is None) and (data is not None):
+            msg = Message(data)
+        if msg is None:
+            raise SSHException('Key object may not be empty')
+        if msg.get_text() != self.name:
+            raise SSHException('Invalid key')
+        self.public_bytes = msg.get_binary()
+        if len(self.public_bytes) != 32:
+            raise SSHException('Invalid key')
+
+    def __getstate__(self):
+        # the cryptography key does not pickle, needed by the kex executor
+        state = dict(self.__dict__)
+        if self.private_key is not None:
+            state['private_key'] = self.private_key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.private_key is not None:
+            self.private_key = Ed25519PrivateKey.from_private_bytes(self.private_key)
+
+    def asbytes(self):
+        m = Message()
+        m.add_string(self.name)
+        m.add_string(self.public_bytes)
+        return m.asbytes()
+
+    def __str__(self):
+        return self.asbytes()
+
+    def __hash__(self):
+        return hash(self.asbytes())
+
+    def get_name(self):
+        return self.name
+
+    def get_bits(self):
+        return 256
+
+    def can_sign(self):
+        return self.private_key is not None
+
+    def sign_ssh_data(self, data):
+        m = Message()
+        m.add_string(self.name)
+        m.add_string(self.private_key.sign(data))
+        return m
+
+    def verify_ssh_sig(self, data, msg):
+        if msg.get_text() != self.name:
+            return False
+        try:
+            Ed25519PublicKey.from_public_bytes(self.public_bytes).verify(msg.get_binary(), data)
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+
+def ed25519_supported():
+    return Ed25519PrivateKey is not None and default_backend().ed25519_supported()
+
+
+def load_host_key(filename):
+    """ Load a private host key of any supported type. The keys in the
+    OpenSSH format, the ssh-keygen default, are read with cryptography,
+    the PEM ones with paramiko.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if b'BEGIN OPENSSH PRIVATE KEY' in data:
+        if load_ssh_private_key is None:
+            raise SSHException('Cannot load %s, the OpenSSH key format needs cryptography' % filename)
+        key = load_ssh_private_key(data, None, default_backend())
+        if ed25519_supported() and isinstance(key, Ed25519PrivateKey):
+            return solt_ed25519_key(private_key=key)
+        if isinstance(key, rsa.RSAPrivateKey):
+            numbers = key.private_numbers()
+            obj = RSAKey(vals=(numbers.public_numbers.e, numbers.public_numbers.n))
+            obj.d = numbers.d
+            obj.p = numbers.p
+            obj.q = numbers.q
+            return obj
+        raise SSHException('Unsupported key type in %s' % filename)
+    for klass in (RSAKey, ECDSAKey, DSSKey):
+        try:
+            return klass.from_private_key_file(filename)
+        except SSHException:
+            pass
+    raise SSHException('Unsupported key type in %s' % filename)
+
+
+def rsa_sha2_keys(key):
+    """ The rsa-sha2 host keys sharing the private part of `key` """
+    return [klass.from_rsa_key(key) for klass in (solt_rsa_sha2_512_key, solt_rsa_sha2_256_key)]
+
+
+# the key algorithms available, preferred first, in the format of the
+# `sftp_wrapper` keys
+host_keys = ()
+host_key_info = {}
+if ed25519_supported():
+    host_keys += ('ssh-ed25519',)
+    host_key_info['ssh-ed25519'] = solt_ed25519_key
+host_keys += ('rsa-sha2-512', 'rsa-sha2-256')
+host_key_info['rsa-sha2-512'] = solt_rsa_sha2_512_key
+host_key_info['rsa-sha2-256'] = solt_rsa_sha2_256_key
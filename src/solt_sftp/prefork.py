@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import resource
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+from gevent.server import StreamServer
+
+from config import config
+
+_logger = logging.getLogger(__name__)
+
+
+# glibc reserves a malloc arena of 64MB of address space per thread
+try:
+    _mallopt = ctypes.CDLL(ctypes.util.find_library('c')).mallopt
+    _mallopt.argtypes = [ctypes.c_int, ctypes.c_int]
+except (OSError, AttributeError):
+    _mallopt = None
+
+M_ARENA_MAX = -8
+# arenas shared by the filesystem threads of a worker
+ARENA_MAX = 2
+
+
+def memory_usage():
+    """ Resident memory size of the current process, in bytes. The virtual
+    size is mostly address space reserved by the threads, not memory used.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # no procfs, the peak resident size is the best we can get
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class solt_prefork(object):
+    """ Supervisor of the prefork mode.
+
+    The listening socket is bound once in the supervisor and inherited by
+    `config['workers']` forked processes, each one running its own gevent hub
+    and `StreamServer` on it. Dead workers are replaced, SIGTERM and SIGINT
+    stop the whole pool.
+
+    Each worker sends a heartbeat through its watchdog pipe, a worker that
+    does not beat for `limit_time_real` seconds has its hub blocked and is
+    killed. A worker reaching `limit_memory_soft` or `limit_request` tells
+    the supervisor it is retiring, a replacement is spawned right away while
+    it drains its sessions.
+
+    Unless the users are loaded lazily, the workers read them from a
+    snapshot file kept up to date by a single loader process, the only one
+    loading the users from Redis and listening to their changes. The
+    workers are spawned once the first snapshot is written.
+    """
+
+    def __init__(self, address, handler_loader):
+        self.address = address
+        # callable returning the connection handler, it is only called in
+        # the workers so the broker and its greenlets are never forked
+        self.handler_loader = handler_loader
+        self.population = int(config['workers'])
+        # the values of the config file are strings, the limits are cast
+        # once for the workers to inherit, 0 disables a limit
+        for key in ('limit_memory_soft', 'limit_memory_hard', 'limit_time_cpu',
+                    'limit_time_real', 'limit_request'):
+            config[key] = int(config[key])
+        self.beat = 4
+        self.workers = {}
+        self.generation = 0
+        self.queue = []
+        self.pipe = None
+        self.socket = None
+        self.snapshot_path = None
+        # seconds between two writes of the users snapshot
+        self.snapshot_delay = 1
+
+    def pipe_new(self):
+        pipe = os.pipe()
+        for fd in pipe:
+            # non-blocking
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+            # close_on_exec
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+        return pipe
+
+    def pipe_ping(self, pipe):
+        try:
+            os.write(pipe[1], '.')
+        except OSError as e:
+            if e.errno not in [errno.EAGAIN, errno.EINTR]:
+                raise
+
+    def signal_handler(self, sig, frame):
+        if len(self.queue) < 5 or sig == signal.SIGCHLD:
+            self.queue.append(sig)
+            self.pipe_ping(self.pipe)
+        else:
+            _logger.warn("Dropping signal: %s", sig)
+
+    def worker_spawn(self, klass=None):
+        self.generation += 1
+        worker = (klass or solt_worker)(self)
+        pid = os.fork()
+        if pid != 0:
+            worker.pid = pid
+            self.workers[pid] = worker
+            return worker
+        else:
+            worker.run()
+            sys.exit(0)
+
+    def worker_pop(self, pid):
+        if pid in self.workers:
+            _logger.debug("Worker (%s) unregistered", pid)
+            try:
+                self.workers.pop(pid).close()
+            except OSError:
+                pass
+
+    def worker_kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                self.worker_pop(pid)
+
+    def process_signals(self):
+        while len(self.queue):
+            sig = self.queue.pop(0)
+            if sig in [signal.SIGINT, signal.SIGTERM]:
+                raise KeyboardInterrupt
+
+    def process_zombie(self):
+        # reap dead workers
+        while 1:
+            try:
+                wpid, status = os.waitpid(-1, os.WNOHANG)
+                if not wpid:
+                    break
+                if os.WIFSIGNALED(status):
+                    _logger.warn("Worker (%s) killed by signal %s", wpid, os.WTERMSIG(status))
+                elif os.WEXITSTATUS(status):
+                    _logger.warn("Worker (%s) exited with status %s", wpid, os.WEXITSTATUS(status))
+                self.worker_pop(wpid)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+    def process_timeout(self):
+        now = time.time()
+        for (pid, worker) in self.workers.items():
+            if worker.watchdog_timeout is not None and \
+                    (now - worker.watchdog_time) >= worker.watchdog_timeout:
+                _logger.error("Worker (%s) timeout after %ss", pid, worker.watchdog_timeout)
+                self.worker_kill(pid, signal.SIGKILL)
+
+    def process_spawn(self):
+        if self.snapshot_path:
+            if not [w for w in self.workers.values() if not w.serving]:
+                self.worker_spawn(solt_user_loader)
+            if not os.path.exists(self.snapshot_path):
+                return
+        while len([w for w in self.workers.values() if w.serving and not w.retiring]) < self.population:
+            self.worker_spawn()
+
+    def sleep(self):
+        try:
+            # map of watchdog fd -> worker
+            fds = dict([(w.watchdog_pipe[0], w) for w in self.workers.values()])
+            fd_in = fds.keys() + [self.pipe[0]]
+            # check for ping or internal wakeups
+            ready = select.select(fd_in, [], [], self.beat)
+            # update worker watchdogs
+            for fd in ready[0]:
+                if fd in fds:
+                    fds[fd].watchdog_ping()
+            # empty pipe
+            while os.read(self.pipe[0], 1):
+                pass
+        except OSError as e:
+            if e.errno not in [errno.EAGAIN, errno.EINTR]:
+                raise
+        except select.error as e:
+            if e[0] not in [errno.EINTR]:
+                raise
+
+    def start(self):
+        # wakeup pipe, python doesnt throw EINTR when a syscall is interrupted
+        # by a signal simulating a pseudo SA_RESTART. We write to a pipe in the
+        # signal handler to overcome this behaviour
+        self.pipe = self.pipe_new()
+        # set signal handlers
+        signal.signal(signal.SIGINT, self.signal_handler)
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGCHLD, self.signal_handler)
+
+        # listen to socket, the workers inherit it and accept on it
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setblocking(0)
+        self.socket.bind(self.address)
+        self.socket.listen(socket.SOMAXCONN)
+
+        if not int(config['user_cache_size']):
+            # the snapshot holds the keys of the users, in a private folder
+            self.snapshot_path = os.path.join(tempfile.mkdtemp(prefix='solt_sftp-'), 'users')
+            config['user_snapshot'] = self.snapshot_path
+
+    def stop(self, graceful=True):
+        if self.socket:
+            self.socket.close()
+        if graceful:
+            _logger.info("Stopping gracefully")
+            limit = config['limit_time_real'] and time.time() + config['limit_time_real']
+            for pid in self.workers.keys():
+                self.worker_kill(pid, signal.SIGTERM)
+            while self.workers and (not limit or time.time() < limit):
+                try:
+                    self.process_signals()
+                except KeyboardInterrupt:
+                    _logger.info("Forced shutdown.")
+                    break
+                self.process_zombie()
+                time.sleep(0.1)
+        else:
+            _logger.info("Stopping forcefully")
+        for pid in self.workers.keys():
+            self.worker_kill(pid, signal.SIGKILL)
+        if self.snapshot_path:
+            shutil.rmtree(os.path.dirname(self.snapshot_path), ignore_errors=True)
+
+    def run(self):
+        self.start()
+        _logger.info('Solt SFTP server is running with %s workers and waiting for connections...', self.population)
+
+        while 1:
+            try:
+                self.process_signals()
+                self.process_zombie()
+                self.process_timeout()
+                self.process_spawn()
+                self.sleep()
+            except KeyboardInterrupt:
+                _logger.debug("Multiprocess clean stop")
+                self.stop()
+                break
+            except Exception as e:
+                _logger.exception(e)
+                self.stop(False)
+                return -1
+
+
+class solt_worker(object):
+    """ A forked process serving SFTP sessions on the supervisor socket. """
+    serving = True
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.watchdog_pipe = supervisor.pipe_new()
+        self.watchdog_time = time.time()
+        self.watchdog_timeout = config['limit_time_real'] or None
+        self.retiring = False
+        self.pid = None
+        self.ppid = os.getpid()
+        self.alive = True
+        self.server = None
+        self.handler = None
+        self.stop_event = None
+        self.request_count = 0
+        self.request_max = config['limit_request']
+        # time of the last beat of the worker loop
+        self.beat_time = None
+
+    def close(self):
+        os.close(self.watchdog_pipe[0])
+        os.close(self.watchdog_pipe[1])
+
+    def watchdog_ping(self):
+        """ Called in the supervisor when the worker wrote to its pipe. """
+        self.watchdog_time = time.time()
+        try:
+            data = os.read(self.watchdog_pipe[0], 4096)
+        except OSError as e:
+            if e.errno not in [errno.EAGAIN, errno.EINTR]:
+                raise
+            return
+        if 'r' in data and not self.retiring:
+            _logger.info("Worker (%s) retiring, spawning a replacement", self.pid)
+            self.retiring = True
+
+    def signal_handler(self):
+        self.alive = False
+        self.stop_event.set()
+
+    def handle(self, sock, address):
+        self.request_count += 1
+        if self.request_max and self.request_count >= self.request_max:
+            self.retire("max request (%s) reached." % self.request_max)
+        return self.handler(sock, address)
+
+    def retire(self, reason):
+        """ Stop accepting connections, the sessions in progress are drained
+        and the supervisor replaces us in the meantime.
+        """
+        if self.retiring:
+            return
+        _logger.info("Worker (%s) %s", self.pid, reason)
+        self.retiring = True
+        self.server.close()
+        self.stop_event.set()
+
+    def process_limit(self):
+        # If our parent changed sucide
+        if self.ppid != os.getppid():
+            _logger.info("Worker (%s) Parent changed", self.pid)
+            self.alive = False
+        # check for lifetime
+        if self.request_max and self.request_count >= self.request_max:
+            self.retire("max request (%s) reached." % self.request_max)
+        # Reset the worker if it consumes too much memory (e.g. caused by a memory leak).
+        if config['limit_memory_soft'] and memory_usage() > config['limit_memory_soft']:
+            self.retire("resident memory limit (%s) reached." % config['limit_memory_soft'])
+        # A greenlet keeping the hub busy delays the beat by as much, the
+        # filesystem threads do not. The watchdog kills the worker when
+        # the hub stays blocked for limit_time_real seconds.
+        now = time.time()
+        if config['limit_time_cpu'] and self.beat_time is not None:
+            blocked = now - self.beat_time - self.supervisor.beat
+            if blocked > config['limit_time_cpu']:
+                self.retire("hub blocked for %ds, more than limit_time_cpu (%s)." %
+                            (blocked, config['limit_time_cpu']))
+        self.beat_time = now
+        if self.retiring and not len(self.server.pool):
+            self.alive = False
+
+    def process_heartbeat(self):
+        try:
+            os.write(self.watchdog_pipe[1], 'r' if self.retiring else '.')
+        except OSError as e:
+            if e.errno not in [errno.EAGAIN, errno.EINTR]:
+                raise
+
+    def sleep(self):
+        self.stop_event.wait(self.supervisor.beat)
+        self.stop_event.clear()
+
+    def start(self):
+        self.pid = os.getpid()
+        # the supervisor signal handlers and pipes belong to it only
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in self.supervisor.pipe:
+            os.close(fd)
+        os.close(self.watchdog_pipe[0])
+
+        # before the filesystem threads start, they would otherwise each
+        # reserve an arena counted by limit_memory_hard
+        if _mallopt is not None:
+            _mallopt(M_ARENA_MAX, ARENA_MAX)
+        if config['limit_memory_hard']:
+            soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (config['limit_memory_hard'], hard))
+
+        gevent.reinit()
+        self.stop_event = Event()
+        gevent.signal(signal.SIGTERM, self.signal_handler)
+        _logger.info("Worker (%s) alive", self.pid)
+        self.serve()
+
+    def serve(self):
+        self.handler = self.supervisor.handler_loader()
+        self.server = StreamServer(self.supervisor.socket, self.handle, spawn=Pool())
+        self.server.start()
+
+    def stop(self):
+        if not self.server.closed:
+            self.server.close()
+        if len(self.server.pool):
+            _logger.info("Worker (%s) stopping, waiting for %s sessions", self.pid, len(self.server.pool))
+            self.server.pool.join(timeout=config['limit_time_real'] or None)
+            self.server.pool.kill(block=True, timeout=1)
+
+    def run(self):
+        try:
+            self.start()
+            while self.alive:
+                self.process_limit()
+                self.process_heartbeat()
+                self.sleep()
+            self.stop()
+        except Exception:
+            _logger.exception("Worker (%s) Exception occured, exiting..." % self.pid)
+            # should we use 3 to abort everything ?
+            sys.exit(1)
+        _logger.info("Worker (%s) exiting. request_count: %s.", self.pid, self.request_count)
+
+
+class solt_user_loader(solt_worker):
+    """ The process loading the users from Redis and writing the snapshot
+    read by the workers, again at most every `snapshot_delay` seconds while
+    the users change.
+    """
+    serving = False
+
+    def __init__(self, supervisor):
+        super(solt_user_loader, self).__init__(supervisor)
+        self.broker = None
+        self.writer = None
+
+    def serve(self):
+        from broker import solt_broker
+        self.broker = solt_broker()
+        self.writer = gevent.spawn(self.write_loop)
+
+    def write_loop(self):
+        from snapshot import write_snapshot
+        # the workers are spawned once the first snapshot exists, it is
+        # written even when no user was loaded
+        first = True
+        while True:
+            if not first:
+                self.broker.changed.wait()
+            first = False
+            self.broker.changed.clear()
+            start = time.time()
+            write_snapshot(self.supervisor.snapshot_path, self.broker.authorized_keys)
+            _logger.debug("Users snapshot written in %.3fs", time.time() - start)
+            # wakes the supervisor up, the workers wait for the first one
+            self.process_heartbeat()
+            gevent.sleep(self.supervisor.snapshot_delay)
+
+    def process_limit(self):
+        if self.ppid != os.getppid():
+            _logger.info("Worker (%s) Parent changed", self.pid)
+            self.alive = False
+        if self.writer.dead:
+            _logger.error("Users loader (%s) snapshot writer died: %s", self.pid, self.writer.exception)
+            self.alive = False
+        if self.broker.subscriber_greenlet.dead:
+            _logger.error("Users loader (%s) Redis listener died: %s", self.pid,
+                          self.broker.subscriber_greenlet.exception)
+            self.alive = False
+
+    def stop(self):
+        self.writer.kill()
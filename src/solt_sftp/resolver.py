@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import posixpath
+import stat
+from collections import OrderedDict
+
+from executor import fs_executor
+
+
+class solt_path_resolver(object):
+    """ Maps the paths of an SFTP session to the filesystem, confined to the
+    user root folder.
+
+    Paths are normalized lexically so '..' can not climb above the root.
+    Symlinks are the only other way out: the folders a path goes through
+    are checked with `realpath` once and remembered in a bounded LRU, the
+    last component is only resolved when `check_link` finds a link. The
+    `realpath` calls run in the filesystem threads, the LRU is only
+    updated from the hub.
+    """
+    cache_size = 256
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        # verified folders, the most recently used last
+        self.verified = OrderedDict()
+        # bumped by forget, a check started before is not remembered
+        self.generation = 0
+
+    def resolve(self, sftp_path):
+        path = posixpath.normpath('/' + sftp_path.lstrip('/'))
+        if path == '/':
+            return self.root
+        real_path = self.root + path
+        self.check_folder(posixpath.dirname(real_path))
+        return real_path
+
+    def check_folder(self, folder):
+        if folder in self.verified:
+            self.verified[folder] = self.verified.pop(folder)
+            return
+        generation = self.generation
+        self.check_real(fs_executor.call('resolve', os.path.realpath, folder))
+        if generation != self.generation:
+            return
+        self.verified[folder] = True
+        if len(self.verified) > self.cache_size:
+            self.verified.popitem(last=False)
+
+    def check(self, real_path):
+        self.check_real(os.path.realpath(real_path))
+
+    def check_real(self, real):
+        if real != self.root and not real.startswith(self.root + '/'):
+            raise Exception("Invalid path")
+
+    def check_link(self, real_path):
+        """ Check the last component of a resolved path. It does not touch
+        the LRU so it can run in the filesystem threads.
+        """
+        try:
+            st = os.lstat(real_path)
+        except OSError:
+            return
+        if stat.S_ISLNK(st.st_mode):
+            self.check(real_path)
+
+    def forget(self, real_path):
+        """ Drop the verified folders at or below a renamed or removed path. """
+        self.generation += 1
+        prefix = real_path + '/'
+        for folder in list(self.verified):
+            if folder == real_path or folder.startswith(prefix):
+                del self.verified[folder]
@@ -23,12 +23,21 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import gevent
 from gevent.event import Event
+from gevent.lock import Semaphore
+from gevent.pool import Pool
 
 #monkey.patch_all()
 
 from binascii import hexlify
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import errno
+import hashlib
 import os
+import struct
 import sys
 import logging
 
@@ -37,40 +46,769 @@ from paramiko.py3compat import u
 
 from wrapper import sftp_wrapper
 from broker import solt_broker
+from snapshot import solt_user_snapshot
+from executor import fs_executor
+from keys import load_host_key
+from resolver import solt_path_resolver
+from stats import stats
 
 from config import config
 from paramiko.sftp_server import SFTPServer
 from paramiko.sftp_handle import SFTPHandle
 from paramiko.sftp_attr import SFTPAttributes
-from paramiko.sftp import SFTP_OK
-import base64
+from paramiko.sftp import SFTP_OK, SFTP_EOF, SFTP_FAILURE, SFTP_BAD_MESSAGE, SFTP_OP_UNSUPPORTED, \
+    CMD_INIT, CMD_VERSION, CMD_READ, CMD_WRITE, CMD_DATA, CMD_CLOSE, CMD_FSTAT, CMD_FSETSTAT, \
+    CMD_READDIR, CMD_EXTENDED, CMD_EXTENDED_REPLY, SFTPError, _VERSION
 import shutil
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# python 2 has no os.pread, the ctypes calls release the GIL
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _pread = _libc.pread64
+    _pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+    _pread.restype = ctypes.c_ssize_t
+    _pwritev = _libc.pwritev64
+    _pwritev.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_int64]
+    _pwritev.restype = ctypes.c_ssize_t
+    _fadvise = _libc.posix_fadvise64
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+except (OSError, AttributeError):
+    _pread = _pwritev = _fadvise = None
+# glibc 2.27
+try:
+    _copy_file_range = _libc.copy_file_range
+    _copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+    _copy_file_range.restype = ctypes.c_ssize_t
+except (NameError, AttributeError):
+    _copy_file_range = None
+
+POSIX_FADV_SEQUENTIAL = 2
+IOV_MAX = 1024
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
 _logger = logging.getLogger(__name__)
 
-solt_sftp_key = paramiko.RSAKey.from_private_key_file(config.get('sftp_key', 'solt_sftp.key'))
 
-redis_broker = solt_broker()
+def pread_into(fd, buf, pos, length, offset):
+    """ Read up to `length` bytes of `fd` at `offset` into the bytearray
+    `buf` at `pos`, the file position is left untouched.
+    """
+    target = (ctypes.c_char * length).from_buffer(buf, pos)
+    while True:
+        n = _pread(fd, target, length, offset)
+        if n >= 0:
+            return n
+        e = ctypes.get_errno()
+        if e != errno.EINTR:
+            raise OSError(e, os.strerror(e))
+
+
+def pwrite_all(fd, chunks, offset):
+    """ Write the strings `chunks` one after the other at `offset` of `fd`,
+    in a single pwritev without joining them unless it writes partially.
+    """
+    if len(chunks) > IOV_MAX:
+        chunks = [''.join(chunks)]
+    while chunks:
+        iov = (iovec * len(chunks))()
+        for i, chunk in enumerate(chunks):
+            # c_char_p points to the string data, it is not copied
+            iov[i].iov_base = ctypes.cast(ctypes.c_char_p(chunk), ctypes.c_void_p)
+            iov[i].iov_len = len(chunk)
+        n = _pwritev(fd, iov, len(chunks), offset)
+        if n < 0:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            raise OSError(e, os.strerror(e))
+        data = ''.join(chunks)[n:] if n < sum(len(chunk) for chunk in chunks) else ''
+        chunks = [data] if data else []
+        offset += n
+
+def copy_range(src_fd, src_offset, length, dst_fd, dst_offset):
+    """ Copy `length` bytes, or up to the end of the file when 0, from
+    `src_offset` of `src_fd` to `dst_offset` of `dst_fd`. The kernel copies
+    them with copy_file_range, or pread and pwritev when it can not.
+    """
+    end = src_offset + length if length else None
+    src = ctypes.c_int64(src_offset)
+    dst = ctypes.c_int64(dst_offset)
+    while _copy_file_range is not None and (end is None or src.value < end):
+        size = min(end - src.value, 1 << 30) if end is not None else 1 << 30
+        n = _copy_file_range(src_fd, ctypes.byref(src), dst_fd, ctypes.byref(dst), size, 0)
+        if n == 0:
+            return
+        if n < 0:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            # not supported by the kernel or across these filesystems
+            if e in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                break
+            raise OSError(e, os.strerror(e))
+    buf = bytearray(solt_handle.max_read)
+    while end is None or src.value < end:
+        size = min(end - src.value, len(buf)) if end is not None else len(buf)
+        n = pread_into(src_fd, buf, 0, size, src.value)
+        if not n:
+            return
+        pwrite_all(dst_fd, [str(buf[:n])], dst.value)
+        src.value += n
+        dst.value += n
+
+# several host keys may be given, comma separated, the client picks the type
+solt_sftp_keys = [load_host_key(path.strip()) for path in config.get('sftp_key', 'solt_sftp.key').split(',')]
+
+# in prefork mode the workers read the users snapshot of the loader process
+if config.get('user_snapshot'):
+    redis_broker = solt_user_snapshot(config['user_snapshot'])
+else:
+    redis_broker = solt_broker()
+
+stats.start(int(config['stats_interval']))
 
 class solt_handle(SFTPHandle):
+    """ File handle reading with pread. Once the client reads sequentially
+    the next chunks are read ahead in the filesystem threads, into at most
+    `readahead_size` bytes of buffers per handle. A chunk read ahead is
+    only served while the mtime and size of the file are still the ones
+    seen before reading it, the writes of other handles, sessions or
+    processes drop the chunks.
+
+    Contiguous writes are answered at once and gathered, up to
+    `write_buffer_size` bytes, into a pwritev run in a filesystem thread
+    while the next ones arrive. A write error is returned by a later
+    write, the fsync or the close of the handle.
+    """
+    # the CMD_DATA header: packet length, type, request id and data length
+    data_header = struct.Struct('>IBII')
+    max_read = 256 * 1024
+    readahead_size = int(config['readahead_size'])
+    write_buffer_size = int(config['write_buffer_size'])
+    # consecutive reads before reading ahead
+    sequential_reads = 2
+
+    def __init__(self, flags=0):
+        super(solt_handle, self).__init__(flags)
+        self.read_buffer = None
+        self.next_offset = None
+        self.sequential = 0
+        self.eof = None
+        # offset -> (length, buffer, greenlet) of the chunks read ahead
+        self.ahead = OrderedDict()
+        self.ahead_offset = 0
+        self.fetching = set()
+        self.free = []
+        self.slot_size = 0
+        self.slots = 0
+        self.served = None
+        self.pending = []
+        self.pending_offset = 0
+        self.pending_size = 0
+        self.flushing = None
+        self.write_error = None
+
+    def read(self, offset, length):
+        self.drain()
+        return fs_executor.call('read', self._read, offset, length)
+
+    def _read(self, offset, length):
+        if _pread is None:
+            return SFTPHandle.read(self, offset, length)
+        buf = bytearray(length)
+        try:
+            n = pread_into(self.readfile.fileno(), buf, 0, length, offset)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return str(buf[:n])
+
+    def read_packet(self, request_number, offset, length):
+        """ The CMD_DATA packet answering a read or an SFTP error code. The
+        data is read with pread right after the header in a buffer of the
+        handle, the packet is only valid until the next read.
+        """
+        length = min(length, self.max_read)
+        self.drain()
+        if self.served is not None:
+            self.release(self.served)
+            self.served = None
+        if offset == self.next_offset:
+            self.sequential += 1
+        else:
+            self.sequential = 0
+            self.drop_ahead()
+        self.next_offset = offset + length
+        chunk = self.ahead.pop(offset, None)
+        if chunk is not None and (chunk[0] != length or self.stale(chunk)):
+            self.release(chunk[1], chunk[2])
+            self.drop_ahead()
+            chunk = None
+        if chunk is None:
+            packet = fs_executor.call('read', self._read_packet, request_number, offset, length)
+        else:
+            stats.incr('fs.readahead.hit')
+            packet = self.ahead_packet(request_number, chunk)
+        if self.sequential >= self.sequential_reads and self.readahead_size and length and _pread is not None:
+            if self.sequential == self.sequential_reads and _fadvise is not None:
+                # widens the kernel read ahead of the file as well
+                _fadvise(self.readfile.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+            self.read_ahead(length)
+        return packet
+
+    def _read_packet(self, request_number, offset, length):
+        if _pread is None:
+            data = SFTPHandle.read(self, offset, length)
+            if not isinstance(data, str):
+                return data
+            if not data and self.at_eof(offset, length):
+                return SFTP_EOF
+            return self.data_header.pack(len(data) + 9, CMD_DATA, request_number, len(data)) + data
+        size = self.data_header.size + length
+        if self.read_buffer is None or len(self.read_buffer) < size:
+            self.read_buffer = bytearray(size)
+        try:
+            n = pread_into(self.readfile.fileno(), self.read_buffer, self.data_header.size, length, offset)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if not n and self.at_eof(offset, length):
+            return SFTP_EOF
+        self.data_header.pack_into(self.read_buffer, 0, n + 9, CMD_DATA, request_number, n)
+        return buffer(self.read_buffer, 0, self.data_header.size + n)
+
+    def at_eof(self, offset, length):
+        """ Whether a read returning no data is past the end of the file,
+        a read of 0 bytes inside the file is answered with empty data.
+        """
+        if length:
+            return True
+        try:
+            return offset >= os.fstat(self.readfile.fileno()).st_size
+        except OSError:
+            return True
+
+    def ahead_packet(self, request_number, chunk):
+        length, slot, greenlet = chunk
+        n, version = greenlet.get()
+        if n <= 0:
+            self.release(slot)
+            return SFTPServer.convert_errno(-n) if n else SFTP_EOF
+        self.served = slot
+        self.data_header.pack_into(slot, 0, n + 9, CMD_DATA, request_number, n)
+        return buffer(slot, 0, self.data_header.size + n)
+
+    def read_ahead(self, length):
+        slot_size = self.data_header.size + length
+        if slot_size != self.slot_size:
+            self.slots -= len(self.free)
+            self.free = []
+            self.slot_size = slot_size
+        self.ahead_offset = max(self.ahead_offset, self.next_offset)
+        while self.eof is None or self.ahead_offset < self.eof:
+            if self.free:
+                slot = self.free.pop()
+            elif (self.slots + 1) * slot_size <= self.readahead_size:
+                slot = bytearray(slot_size)
+                self.slots += 1
+            else:
+                break
+            greenlet = gevent.spawn(fs_executor.call, 'readahead', self._fetch, slot, self.ahead_offset, length)
+            self.fetching.add(greenlet)
+            greenlet.link(self.fetching.discard)
+            self.ahead[self.ahead_offset] = (length, slot, greenlet)
+            self.ahead_offset += length
+
+    def _fetch(self, slot, offset, length):
+        # the version is taken first, a write landing after it changes it
+        try:
+            version = self.version()
+            n = pread_into(self.readfile.fileno(), slot, self.data_header.size, length, offset)
+        except OSError as e:
+            return -e.errno, None
+        if n < length:
+            self.eof = offset + n
+        return n, version
+
+    def version(self):
+        st = os.fstat(self.readfile.fileno())
+        return st.st_mtime, st.st_size
+
+    def stale(self, chunk):
+        """ Whether the file changed since the chunk was read ahead """
+        n, version = chunk[2].get()
+        if version is None:
+            return False
+        try:
+            stale = self.version() != version
+        except OSError:
+            stale = True
+        if stale:
+            stats.incr('fs.readahead.stale')
+        return stale
+
+    def release(self, slot, greenlet=None):
+        """ Give back a buffer, once its read is over """
+        if greenlet is not None and not greenlet.ready():
+            greenlet.link(lambda g: self.release(slot))
+        elif len(slot) == self.slot_size:
+            self.free.append(slot)
+        else:
+            self.slots -= 1
+
+    def drop_ahead(self):
+        for length, slot, greenlet in self.ahead.values():
+            self.release(slot, greenlet)
+        self.ahead.clear()
+        self.ahead_offset = 0
+        self.eof = None
+
+    def forget_reads(self):
+        """ The data read ahead is stale once the handle writes """
+        self.drop_ahead()
+        self.next_offset = None
+        self.sequential = 0
+
+    def close(self):
+        """ Close the file once the reads ahead and the writes are over,
+        the error of a write not reported yet is returned.
+        """
+        self.drain()
+        gevent.joinall(list(self.fetching))
+        self.drop_ahead()
+        super(solt_handle, self).close()
+        return self.pop_write_error()
+
+    def write(self, offset, data):
+        self.forget_reads()
+        if self.write_error is not None:
+            return self.pop_write_error()
+        if _pwritev is None:
+            return fs_executor.call('write', SFTPHandle.write, self, offset, data)
+        if not self.write_buffer_size:
+            return fs_executor.call('write', self._write, offset, [data])
+        if self.pending and (offset != self.pending_offset + self.pending_size or
+                             self.pending_size + len(data) > self.write_buffer_size):
+            self.flush()
+        if not self.pending:
+            self.pending_offset = offset
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.write_buffer_size:
+            self.flush()
+        return SFTP_OK
+
+    def _write(self, offset, chunks):
+        try:
+            pwrite_all(self.writefile.fileno(), chunks, offset)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def flush(self):
+        """ Start writing the gathered writes, after the previous ones """
+        if not self.pending:
+            return
+        if self.flushing is not None:
+            self.flushing.join()
+        self.flushing = gevent.spawn(self._flush, self.pending_offset, self.pending)
+        self.pending = []
+        self.pending_size = 0
+
+    def _flush(self, offset, chunks):
+        status = fs_executor.call('write', self._write, offset, chunks)
+        if status != SFTP_OK and self.write_error is None:
+            self.write_error = status
+
+    def drain(self):
+        """ Wait for all the writes to reach the file """
+        self.flush()
+        if self.flushing is not None:
+            self.flushing.join()
+            self.flushing = None
+
+    def pop_write_error(self):
+        status, self.write_error = self.write_error, None
+        return SFTP_OK if status is None else status
+
+    def fsync(self):
+        self.drain()
+        status = self.pop_write_error()
+        if status != SFTP_OK:
+            return status
+        return fs_executor.call('fsync', self._fsync)
+
+    def _fsync(self):
+        try:
+            os.fsync(self.writefile.fileno())
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def check_file(self, algorithm, start, length, block_size):
+        """ The `algorithm` hashes of the blocks of `block_size` bytes of
+        the range, the whole range is a single block when 0. A `length` of
+        0 hashes up to the end of the file.
+        """
+        self.drain()
+        return fs_executor.call('check_file', self._check_file, algorithm, start, length, block_size)
+
+    def _check_file(self, algorithm, start, length, block_size):
+        if not length:
+            try:
+                length = os.fstat(self.readfile.fileno()).st_size - start
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+        block_size = block_size or length
+        end = start + length
+        sums = []
+        offset = start
+        while offset < end:
+            block_start = offset
+            block_end = min(offset + block_size, end)
+            hash_obj = hashlib.new(algorithm)
+            while offset < block_end:
+                data = self._read(offset, min(block_end - offset, self.max_read))
+                if not isinstance(data, str):
+                    return data
+                if not data:
+                    break
+                hash_obj.update(data)
+                offset += len(data)
+            if offset == block_start:
+                break
+            sums.append(hash_obj.digest())
+            if offset < block_end:
+                # the last block stops at the end of the file
+                break
+        return ''.join(sums)
+
+    def copy_from(self, source, offset, length, target_offset):
+        """ Copy the range of the `source` handle to `target_offset` of
+        this one, the data never leaves the server.
+        """
+        source.drain()
+        self.drain()
+        self.forget_reads()
+        if self.write_error is not None:
+            return self.pop_write_error()
+        if _pread is None:
+            return SFTP_OP_UNSUPPORTED
+        return fs_executor.call('copy', self._copy_from, source, offset, length, target_offset)
+
+    def _copy_from(self, source, offset, length, target_offset):
+        try:
+            copy_range(source.readfile.fileno(), offset, length, self.writefile.fileno(), target_offset)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
     def stat(self):
+        self.drain()
+        return fs_executor.call('fstat', self._stat)
+
+    def _stat(self):
         try:
             return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
 
     def chattr(self, attr):
+        self.drain()
         try:
             SFTPServer.set_file_attr(self.filename, attr)
             return SFTP_OK
         except OSError as e:
             return SFTPServer.convert_errno(e.errno)
         
+class solt_folder(SFTPHandle):
+    """ Directory listing handle. The entries are read and stat'ed one
+    READDIR page at a time, a big folder is never held in memory. The
+    directory stays open until the listing ends or the handle is closed,
+    by CLOSE or at the end of the session.
+    """
+    page_size = 100
+
+    def __init__(self, real_path, entries):
+        super(solt_folder, self).__init__()
+        self.real_path = real_path
+        # scandir iterator, or the names from listdir without scandir
+        self.entries = iter(entries)
+
+    def _get_next_files(self):
+        return fs_executor.call('readdir', self._read_page)
+
+    def _read_page(self):
+        page = []
+        while self.entries is not None and len(page) < self.page_size:
+            entry = next(self.entries, None)
+            if entry is None:
+                self.close()
+                break
+            try:
+                if scandir is not None:
+                    # the attributes still cost a stat per entry, scandir
+                    # only avoids listing the whole folder at once
+                    name, st = entry.name, entry.stat()
+                else:
+                    name, st = entry, os.stat(os.path.join(self.real_path, entry))
+            except OSError:
+                # removed since the folder was opened
+                continue
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            page.append(SFTPAttributes.from_stat(st, name))
+        return page
+
+    def close(self):
+        """ Release the directory, without close the scandir iterator
+        closes it once collected.
+        """
+        entries, self.entries = self.entries, None
+        close = getattr(entries, 'close', None)
+        if close is not None:
+            close()
+
+class solt_sftp_server(SFTPServer):
+    """ SFTP subsystem listing the folders lazily with `solt_folder` and
+    sending the read data straight from the `solt_handle` buffer.
+
+    Up to `sftp_requests` requests of the session are processed at the same
+    time, each in its own greenlet, and answered as soon as they are done.
+    The requests on the same handle run in the order they were received, as
+    do all the requests on paths.
+    """
+    hash_algorithms = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+    # the extensions advertised in the version packet, name and version
+    extension_pairs = [
+        'check-file', ','.join(hash_algorithms),
+        'copy-data', '1',
+        'fsync@openssh.com', '1',
+        'hardlink@openssh.com', '1',
+        'posix-rename@openssh.com', '1',
+    ]
+    # the requests, and extended requests, whose first argument is a handle
+    handle_requests = (CMD_READ, CMD_WRITE, CMD_CLOSE, CMD_FSTAT, CMD_FSETSTAT, CMD_READDIR)
+    handle_extensions = ('check-file', 'check-file-handle', 'fsync@openssh.com')
+
+    def __init__(self, *largs, **kwargs):
+        super(solt_sftp_server, self).__init__(*largs, **kwargs)
+        self.requests = Pool(max(int(config['sftp_requests']), 1))
+        # key of the request (handle or None for the paths) -> last greenlet
+        self.lanes = {}
+        self.send_lock = Semaphore()
+
+    def start_subsystem(self, name, transport, channel):
+        self.sock = channel
+        self._log(logging.DEBUG, 'Started sftp server on channel %s' % repr(channel))
+        self._send_server_version()
+        if self.server.session_started() is False:
+            # the channel is closed by finish_subsystem
+            return
+        try:
+            while True:
+                try:
+                    t, data = self._read_packet()
+                except EOFError:
+                    self._log(logging.DEBUG, 'EOF -- end of session')
+                    return
+                except Exception as e:
+                    self._log(logging.DEBUG, 'Exception on channel: ' + str(e))
+                    self._log(logging.DEBUG, paramiko.util.tb_strings())
+                    return
+                keys = self._request_keys(t, data)
+                previous = [self.lanes[key] for key in keys if key in self.lanes]
+                # blocks while the session has too many requests in flight,
+                # the client is then held back by the channel window
+                greenlet = self.requests.spawn(self._request, previous, keys, t, data)
+                for key in keys:
+                    self.lanes[key] = greenlet
+        finally:
+            # the handles are closed once the session is over
+            self.requests.join()
+
+    def _request_keys(self, t, data):
+        try:
+            if t in self.handle_requests:
+                msg = paramiko.Message(data)
+                msg.get_int()
+                return [msg.get_binary()]
+            if t == CMD_EXTENDED:
+                msg = paramiko.Message(data)
+                msg.get_int()
+                tag = msg.get_text()
+                if tag in self.handle_extensions:
+                    return [msg.get_binary()]
+                if tag == 'copy-data':
+                    handle = msg.get_binary()
+                    msg.get_int64()
+                    msg.get_int64()
+                    return [handle, msg.get_binary()]
+        except Exception:
+            pass
+        return [None]
+
+    def _request(self, previous, keys, t, data):
+        gevent.joinall(previous)
+        msg = paramiko.Message(data)
+        request_number = msg.get_int()
+        try:
+            self._process(t, request_number, msg)
+        except Exception as e:
+            self._log(logging.DEBUG, 'Exception in server processing: ' + str(e))
+            self._log(logging.DEBUG, paramiko.util.tb_strings())
+            # send some kind of failure message, at least
+            try:
+                self._send_status(request_number, SFTP_FAILURE)
+            except:
+                pass
+        finally:
+            current = gevent.getcurrent()
+            for key in keys:
+                if self.lanes.get(key) is current:
+                    del self.lanes[key]
+
+    def _write_all(self, out):
+        # the replies of the concurrent requests must not interleave
+        with self.send_lock:
+            super(solt_sftp_server, self)._write_all(out)
+
+    def _send_server_version(self):
+        # winscp will freak out if the server sends version info before the
+        # client finishes sending INIT.
+        t, data = self._read_packet()
+        if t != CMD_INIT:
+            raise SFTPError('Incompatible sftp protocol')
+        version = struct.unpack('>I', data[:4])[0]
+        msg = paramiko.Message()
+        msg.add_int(_VERSION)
+        msg.add(*self.extension_pairs)
+        self._send_packet(CMD_VERSION, msg)
+        return version
+
+    def _open_folder(self, request_number, path):
+        resp = self.server.open_folder(path)
+        self._send_handle_response(request_number, resp, True)
+
+    def _process(self, t, request_number, msg):
+        if t == CMD_READ:
+            return self._read(request_number, msg)
+        if t == CMD_CLOSE:
+            return self._close(request_number, msg)
+        if t == CMD_EXTENDED:
+            return self._extended(request_number, msg)
+        return super(solt_sftp_server, self)._process(t, request_number, msg)
+
+    def _close(self, request_number, msg):
+        handle = msg.get_binary()
+        if handle in self.folder_table:
+            self.folder_table.pop(handle).close()
+            self._send_status(request_number, SFTP_OK)
+        elif handle in self.file_table:
+            # the writes are only done now, their error is the close one
+            self._send_status(request_number, self.file_table.pop(handle).close())
+        else:
+            self._send_status(request_number, SFTP_BAD_MESSAGE, 'Invalid handle')
+
+    def _extended(self, request_number, msg):
+        tag = msg.get_text()
+        if tag in ('check-file', 'check-file-handle'):
+            self._check_file(request_number, msg)
+        elif tag == 'copy-data':
+            self._copy_data(request_number, msg)
+        elif tag == 'fsync@openssh.com':
+            handle = msg.get_binary()
+            if handle not in self.file_table:
+                self._send_status(request_number, SFTP_BAD_MESSAGE, 'Invalid handle')
+                return
+            self._send_status(request_number, self.file_table[handle].fsync())
+        elif tag == 'hardlink@openssh.com':
+            oldpath = msg.get_text()
+            newpath = msg.get_text()
+            self._send_status(request_number, self.server.hardlink(oldpath, newpath))
+        elif tag == 'posix-rename@openssh.com':
+            oldpath = msg.get_text()
+            newpath = msg.get_text()
+            self._send_status(request_number, self.server.posix_rename(oldpath, newpath))
+        else:
+            self._send_status(request_number, SFTP_OP_UNSUPPORTED)
+
+    def _check_file(self, request_number, msg):
+        # hashed in a filesystem thread, unlike the paramiko one
+        handle = msg.get_binary()
+        alg_list = msg.get_list()
+        start = msg.get_int64()
+        length = msg.get_int64()
+        block_size = msg.get_int()
+        if handle not in self.file_table:
+            self._send_status(request_number, SFTP_BAD_MESSAGE, 'Invalid handle')
+            return
+        for algorithm in alg_list:
+            if algorithm in self.hash_algorithms:
+                break
+        else:
+            self._send_status(request_number, SFTP_FAILURE, 'No supported hash types found')
+            return
+        if block_size and block_size < 256:
+            self._send_status(request_number, SFTP_FAILURE, 'Block size too small')
+            return
+        sums = self.file_table[handle].check_file(algorithm, start, length, block_size)
+        if isinstance(sums, int):
+            self._send_status(request_number, sums, 'Unable to hash file')
+            return
+        msg = paramiko.Message()
+        msg.add_int(request_number)
+        msg.add_string('check-file')
+        msg.add_string(algorithm)
+        msg.add_bytes(sums)
+        self._send_packet(CMD_EXTENDED_REPLY, msg)
+
+    def _copy_data(self, request_number, msg):
+        read_handle = msg.get_binary()
+        read_offset = msg.get_int64()
+        length = msg.get_int64()
+        write_handle = msg.get_binary()
+        write_offset = msg.get_int64()
+        if read_handle not in self.file_table or write_handle not in self.file_table:
+            self._send_status(request_number, SFTP_BAD_MESSAGE, 'Invalid handle')
+            return
+        if read_handle == write_handle and (not length or
+                                            abs(write_offset - read_offset) < length):
+            self._send_status(request_number, SFTP_FAILURE, 'Overlapping ranges')
+            return
+        source = self.file_table[read_handle]
+        target = self.file_table[write_handle]
+        self._send_status(request_number, target.copy_from(source, read_offset, length, write_offset))
+
+    def _read(self, request_number, msg):
+        handle = msg.get_binary()
+        offset = msg.get_int64()
+        length = msg.get_int()
+        if handle not in self.file_table:
+            self._send_status(request_number, SFTP_BAD_MESSAGE, 'Invalid handle')
+            return
+        packet = self.file_table[handle].read_packet(request_number, offset, length)
+        if isinstance(packet, int):
+            self._send_status(request_number, packet)
+        else:
+            self._write_all(packet)
+
 class solt_interface(paramiko.ServerInterface):
     def __init__(self, *largs, **kwargs):
         self.shell = Event()
         self.broker = kwargs.get('broker', None)
         self.wrapper = kwargs.get('wrapper', None)
+        self.resolver = None
 
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
@@ -82,19 +820,12 @@ class solt_interface(paramiko.ServerInterface):
 
     def check_auth_publickey(self, username, key):
         _logger.info('Auth attempt for '+username+' with key: ' + u(hexlify(key.get_fingerprint())))
-        user_cfg = self.broker.authorized_keys.get(username, False)
+        user_cfg = self.broker.get_user(username)
         if not user_cfg:
             _logger.info('Username not found %s', username)
-            self.broker.channel_user_update(username)
-            user_cfg = self.broker.authorized_keys.get(username, False)
         if user_cfg and user_cfg.get('active', False) == 'True':
-            remote_key_dec = base64.decodestring(key.get_base64())
-            remote_key_enc = base64.encodestring(remote_key_dec)
-            for user_key in user_cfg.get('ssh-keys',[]):
-                user_key_dec = base64.decodestring(user_key)
-                user_key_enc = base64.encodestring(user_key_dec)
-                if remote_key_enc == user_key_enc:
-                    return paramiko.AUTH_SUCCESSFUL
+            if hashlib.sha256(key.asbytes()).digest() in user_cfg.get('key-fingerprints', ()):
+                return paramiko.AUTH_SUCCESSFUL
         return paramiko.AUTH_FAILED
     
     def check_auth_gssapi_with_mic(self, username,
@@ -122,18 +853,14 @@ class solt_interface(paramiko.ServerInterface):
         return True
     
     def get_fs_path(self, sftp_path):
-        username = self.wrapper.get_username()
-        folder = self.broker.authorized_keys.get(username).get('folder')
-        real_path = "%s/%s/%s" % (self.broker.root_folder,folder,sftp_path)
-        real_path = real_path.replace('//', '/')
-        
-        if not os.path.realpath(real_path).startswith(self.broker.root_folder):
-            raise Exception("Invalid path")
-
-        return real_path
+        return self.resolver.resolve(sftp_path)
 
     def open(self, path, flags, attr):
         path = self.get_fs_path(path)
+        return fs_executor.call('open', self._open, path, flags, attr)
+
+    def _open(self, path, flags, attr):
+        self.resolver.check_link(path)
         try:
             binary_flag = getattr(os, 'O_BINARY',  0)
             flags |= binary_flag
@@ -172,18 +899,27 @@ class solt_interface(paramiko.ServerInterface):
         fobj.writefile = f
         return fobj
 
-    def list_folder(self, path):
+    def open_folder(self, path):
         real_path = self.get_fs_path(path)
-        if os.path.exists(real_path):
-            rc = []
-            for filename in os.listdir(real_path):
-                full_name = ("%s/%s" % (real_path, filename)).replace("//", "/")
-                rc.append(paramiko.SFTPAttributes.from_stat(os.stat(full_name), filename.replace(self.broker.root_folder, '').encode('utf-8')))
-            return rc
-        return paramiko.SFTP_NO_SUCH_FILE
+        return fs_executor.call('opendir', self._open_folder, real_path)
+
+    def _open_folder(self, real_path):
+        self.resolver.check_link(real_path)
+        try:
+            if scandir is not None:
+                entries = scandir(real_path)
+            else:
+                entries = os.listdir(real_path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return solt_folder(real_path, entries)
  
     def stat(self, path):
         real_path = self.get_fs_path(path)
+        return fs_executor.call('stat', self._stat, real_path, path)
+
+    def _stat(self, real_path, path):
+        self.resolver.check_link(real_path)
         if os.path.exists(real_path):
             return paramiko.SFTPAttributes.from_stat(os.stat(real_path), path)
         return paramiko.SFTP_NO_SUCH_FILE
@@ -193,6 +929,10 @@ class solt_interface(paramiko.ServerInterface):
 
     def remove(self, path):
         real_path = self.get_fs_path(path)
+        return fs_executor.call('remove', self._remove, real_path)
+
+    def _remove(self, real_path):
+        self.resolver.check_link(real_path)
         if os.path.exists(real_path):
             os.remove(real_path)
             return paramiko.SFTP_OK
@@ -201,13 +941,42 @@ class solt_interface(paramiko.ServerInterface):
     def rename(self, oldpath, newpath):
         real_oldpath = self.get_fs_path(oldpath)
         real_newpath = self.get_fs_path(newpath)
+        self.resolver.forget(real_oldpath)
+        self.resolver.forget(real_newpath)
+        return fs_executor.call('rename', self._rename, real_oldpath, real_newpath)
+
+    def _rename(self, real_oldpath, real_newpath):
+        self.resolver.check_link(real_oldpath)
+        self.resolver.check_link(real_newpath)
         if os.path.exists(real_oldpath):
             os.rename(real_oldpath, real_newpath)
             return paramiko.SFTP_OK
         return paramiko.SFTP_NO_SUCH_FILE
 
+    def posix_rename(self, oldpath, newpath):
+        # rename already replaces an existing target like rename(2)
+        return self.rename(oldpath, newpath)
+
+    def hardlink(self, oldpath, newpath):
+        real_oldpath = self.get_fs_path(oldpath)
+        real_newpath = self.get_fs_path(newpath)
+        return fs_executor.call('hardlink', self._hardlink, real_oldpath, real_newpath)
+
+    def _hardlink(self, real_oldpath, real_newpath):
+        self.resolver.check_link(real_oldpath)
+        self.resolver.check_link(real_newpath)
+        try:
+            os.link(real_oldpath, real_newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
     def mkdir(self, path, attr):
         real_path = self.get_fs_path(path)
+        return fs_executor.call('mkdir', self._mkdir, real_path)
+
+    def _mkdir(self, real_path):
+        self.resolver.check_link(real_path)
         if os.path.exists(real_path):
             return paramiko.SFTP_PERMISSION_DENIED
         os.makedirs(real_path)
@@ -215,6 +984,11 @@ class solt_interface(paramiko.ServerInterface):
 
     def rmdir(self, path):
         real_path = self.get_fs_path(path)
+        self.resolver.forget(real_path)
+        return fs_executor.call('rmdir', self._rmdir, real_path)
+
+    def _rmdir(self, real_path):
+        self.resolver.check_link(real_path)
         if os.path.exists(real_path):
             shutil.rmtree(real_path, ignore_errors=True)
             return paramiko.SFTP_OK
@@ -248,6 +1022,19 @@ class solt_interface(paramiko.ServerInterface):
         return paramiko.SFTP_OP_UNSUPPORTED
     
     def session_started(self):
+        # the user root is resolved once per session
+        user_cfg = self.broker.get_user(self.wrapper.get_username())
+        if not user_cfg:
+            _logger.info('User %s removed since its authentication, closing the session',
+                         self.wrapper.get_username())
+            return False
+        # the folders of the users loaded at startup may still be pending
+        fs_executor.call('user_folders', self.broker.create_folders, [user_cfg.get('folder')])
+        self.resolver = fs_executor.call('resolve', solt_path_resolver,
+                                         '%s/%s' % (self.broker.root_folder, user_cfg.get('folder')))
+        return True
+
+    def session_ended(self):
         pass
 
 try:
@@ -259,8 +1046,9 @@ except:
 def handle_sftp_session(sock, address):
     server_interface = solt_interface(broker=redis_broker)
     session = sftp_wrapper(sock, server_mode = True, server_object=server_interface, active=True)
-    session.set_subsystem_handler('sftp', paramiko.SFTPServer, sftp_si=solt_interface, broker=redis_broker, wrapper=session)
+    session.set_subsystem_handler('sftp', solt_sftp_server, sftp_si=solt_interface, broker=redis_broker, wrapper=session)
     
-    session.add_server_key(solt_sftp_key)
+    for key in solt_sftp_keys:
+        session.add_server_key(key)
     
     session.run()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+import redis
+
+from broker import create_folders, key_fingerprints, pooled_redis, solt_unknown_users
+from config import config
+from stats import stats
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = 'SOLTUSR1'
+# magic, number of buckets, number of users
+HEADER = struct.Struct('<8sII')
+# offset of the user record, 0 for an empty bucket
+BUCKET = struct.Struct('<I')
+# lengths of the name, id, folder and active fields, number of keys
+RECORD = struct.Struct('<HHHBH')
+FINGERPRINT_SIZE = 32
+
+
+def bucket_of(user_name, buckets):
+    return zlib.crc32(user_name) & (buckets - 1)
+
+
+def write_snapshot(path, users):
+    """ Write the `users` records to `path` as an open addressing hash
+    table of the usernames. The file is replaced atomically so readers
+    never see it half written.
+    """
+    buckets = 8
+    while buckets < len(users) * 2:
+        buckets *= 2
+    table = [0] * buckets
+    records = []
+    offset = HEADER.size + BUCKET.size * buckets
+    for user_name, user_cfg in users.iteritems():
+        fields = [user_name, str(user_cfg['id']), user_cfg['folder'], user_cfg.get('active') or '']
+        fingerprints = sorted(user_cfg['key-fingerprints'])
+        record = RECORD.pack(*[len(f) for f in fields] + [len(fingerprints)])
+        record += ''.join(fields) + ''.join(fingerprints)
+        i = bucket_of(user_name, buckets)
+        while table[i]:
+            i = (i + 1) & (buckets - 1)
+        table[i] = offset
+        records.append(record)
+        offset += len(record)
+    # created exclusively and only readable by the server user
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.users-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, buckets, len(users)))
+            f.write(struct.pack('<%dI' % buckets, *table))
+            f.writelines(records)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class solt_user_snapshot(object):
+    """ Read-only view of the users snapshot written by the loader process
+    in prefork mode, in place of a `solt_broker` per worker.
+
+    The file is memory mapped so every worker shares the same pages, a
+    lookup only copies the record of the user. A replaced file is mapped
+    again at most every `check_interval` seconds.
+
+    A username missing from the snapshot, like a user added since its last
+    write, is read from Redis and not kept, the next snapshot has it. The
+    usernames missing in Redis too are remembered `unknown_user_ttl`
+    seconds.
+    """
+    check_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.root_folder = config.get('sftp_path','/opt/solt_sftp/files')
+        self.map = None
+        self.inode = None
+        self.buckets = 0
+        self.checked = 0
+        # connected on the first miss, after the fork of the worker
+        self.redis_conn = None
+        self.unknown_users = solt_unknown_users(int(config.get('unknown_user_ttl', 60)))
+
+    def refresh(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return
+        if inode == self.inode:
+            return
+        with open(self.path, 'rb') as f:
+            snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, buckets, count = HEADER.unpack_from(snapshot)
+        if magic != MAGIC:
+            _logger.error("Invalid users snapshot %s", self.path)
+            snapshot.close()
+            return
+        if self.map is not None:
+            self.map.close()
+        self.map, self.inode, self.buckets = snapshot, inode, buckets
+        _logger.debug("Users snapshot mapped, %d users", count)
+
+    def get_user(self, user_name):
+        if isinstance(user_name, unicode):
+            user_name = user_name.encode('utf-8')
+        user_cfg = self.lookup(user_name)
+        if user_cfg is None:
+            user_cfg = self.fetch_user(user_name)
+        return user_cfg
+
+    def lookup(self, user_name):
+        self.refresh()
+        if self.map is None:
+            return None
+        i = bucket_of(user_name, self.buckets)
+        while True:
+            offset, = BUCKET.unpack_from(self.map, HEADER.size + BUCKET.size * i)
+            if not offset:
+                return None
+            lengths = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            if lengths[0] == len(user_name) and self.map[start:start + lengths[0]] == user_name:
+                return self.read_record(start, lengths)
+            i = (i + 1) & (self.buckets - 1)
+
+    def read_record(self, start, lengths):
+        fields = []
+        for length in lengths[:4]:
+            fields.append(self.map[start:start + length])
+            start += length
+        fingerprints = self.map[start:start + lengths[4] * FINGERPRINT_SIZE]
+        return {
+            'id': fields[1],
+            'name': fields[0],
+            'active': fields[3] or None,
+            'folder': fields[2],
+            'key-fingerprints': frozenset(fingerprints[i:i + FINGERPRINT_SIZE]
+                                          for i in range(0, len(fingerprints), FINGERPRINT_SIZE)),
+        }
+
+    def create_folders(self, folders):
+        """ Blocking, to be run in the filesystem threads. """
+        create_folders(self.root_folder, folders)
+
+    def fetch_user(self, user_name):
+        if user_name in self.unknown_users:
+            return None
+        if self.redis_conn is None:
+            self.redis_conn = pooled_redis()
+        try:
+            user_id = self.redis_conn.hget('solt_sftp:user', user_name)
+            user_data = user_ssh = None
+            if user_id:
+                pipe = self.redis_conn.pipeline(transaction=False)
+                pipe.hgetall('solt_sftp:user:%s:data' % user_id)
+                pipe.smembers('solt_sftp:user:%s:keys' % user_id)
+                user_data, user_ssh = pipe.execute()
+        except redis.RedisError as e:
+            _logger.warning("Can not read the user %s missing from the snapshot: %s", user_name, e)
+            return None
+        stats.incr('users.snapshot_miss')
+        if not user_data:
+            self.unknown_users.add(user_name)
+            return None
+        if not user_data.get('folder'):
+            # the loader assigns it, the user is in the next snapshot
+            return None
+        return {
+            'id': user_id,
+            'name': user_data.get('name'),
+            'active': user_data.get('active'),
+            'folder': user_data['folder'],
+            'key-fingerprints': key_fingerprints(user_name, user_ssh),
+        }
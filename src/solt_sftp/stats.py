@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Axel Mendoza <aekroft@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import time
+
+import gevent
+
+_logger = logging.getLogger(__name__)
+
+
+class solt_stats(object):
+    """ Counters and timings of the current process.
+
+    They are written to the log every `stats_interval` seconds and reset,
+    so each line describes the last interval.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        # name -> [count, total seconds, max seconds]
+        self.timings = {}
+        self.greenlet = None
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = [0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+        if seconds > timing[2]:
+            timing[2] = seconds
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def log(self):
+        for name in sorted(self.counters):
+            _logger.info('%s: %s', name, self.counters[name])
+        for name in sorted(self.timings):
+            count, total, highest = self.timings[name]
+            _logger.info('%s: count=%d avg=%.3fms max=%.3fms total=%.3fs',
+                         name, count, total * 1000 / count, highest * 1000, total)
+        self.reset()
+
+    def logger(self, interval):
+        while True:
+            gevent.sleep(interval)
+            self.log()
+
+    def start(self, interval):
+        if interval and self.greenlet is None:
+            self.greenlet = gevent.spawn(self.logger, interval)
+
+stats = solt_stats()
@@ -28,7 +28,7 @@ import socket
 import sys
 import time
 import weakref
-from hashlib import md5, sha1
+from hashlib import md5, sha1, sha256, sha512
 
 import paramiko
 from paramiko import util
@@ -49,14 +49,11 @@ from paramiko.common import xffffffff, cMSG_CHANNEL_OPEN, cMSG_IGNORE, \
     MAX_WINDOW_SIZE, DEFAULT_WINDOW_SIZE, DEFAULT_MAX_PACKET_SIZE
 from paramiko.compress import ZlibCompressor, ZlibDecompressor
 from paramiko.dsskey import DSSKey
-from paramiko.kex_gex import KexGex
-from paramiko.kex_group1 import KexGroup1
-from paramiko.kex_group14 import KexGroup14
 from paramiko.kex_gss import KexGSSGex, KexGSSGroup1, KexGSSGroup14, NullHostKey
 from paramiko.message import Message
-from paramiko.packet import Packetizer, NeedRekeyException
+from paramiko.packet import NeedRekeyException
 from paramiko.primes import ModulusPack
-from paramiko.py3compat import string_types, long, byte_ord, b
+from paramiko.py3compat import string_types, long, byte_ord, byte_chr, b
 from paramiko.rsakey import RSAKey
 from paramiko.ecdsakey import ECDSAKey
 from paramiko.server import ServerInterface
@@ -66,10 +63,17 @@ from paramiko.ssh_exception import (SSHException, BadAuthenticationType,
 from paramiko.util import retry_on_signal, ClosingContextManager, clamp_value
 
 from Crypto.Cipher import Blowfish, AES, DES3, ARC4
+from gevent import Timeout
 from gevent.event import Event
 from gevent.threading import Lock
 from gevent._threading import Condition
 import logging
+
+from aead import aead_ciphers, aead_cipher_info
+from kex import ecdh_kex, ecdh_kex_info, solt_kex_gex, solt_kex_group1, solt_kex_group14
+from keys import host_keys, host_key_info, rsa_sha2_keys
+from packetizer import solt_packetizer
+from stats import stats
 try:
     from Crypto.Util import Counter
 except ImportError:
@@ -77,16 +81,19 @@ except ImportError:
     
 _logger = logging.getLogger(__name__)
 
+cMSG_EXT_INFO = byte_chr(7)
+
 class sftp_wrapper(object):
     
     _PROTO_ID = '2.0'
     _CLIENT_ID = 'paramiko_%s' % paramiko.__version__
 
-    _preferred_ciphers = ('aes128-ctr', 'aes256-ctr', 'aes128-cbc', 'blowfish-cbc',
+    _preferred_ciphers = aead_ciphers + ('aes128-ctr', 'aes256-ctr', 'aes128-cbc', 'blowfish-cbc',
                           'aes256-cbc', '3des-cbc', 'arcfour128', 'arcfour256')
-    _preferred_macs = ('hmac-sha1', 'hmac-md5', 'hmac-sha1-96', 'hmac-md5-96')
-    _preferred_keys = ('ssh-rsa', 'ssh-dss', 'ecdsa-sha2-nistp256')
-    _preferred_kex =  ( 'diffie-hellman-group14-sha1', 'diffie-hellman-group-exchange-sha1' , 'diffie-hellman-group1-sha1')
+    _preferred_macs = ('hmac-sha2-256-etm@openssh.com', 'hmac-sha2-512-etm@openssh.com', 'hmac-sha2-256',
+                       'hmac-sha2-512', 'hmac-sha1', 'hmac-md5', 'hmac-sha1-96', 'hmac-md5-96')
+    _preferred_keys = host_keys + ('ssh-rsa', 'ssh-dss', 'ecdsa-sha2-nistp256')
+    _preferred_kex = ecdh_kex + ('diffie-hellman-group14-sha1', 'diffie-hellman-group-exchange-sha1' , 'diffie-hellman-group1-sha1')
     _preferred_compression = ('none',)
 
     _cipher_info = {
@@ -99,8 +106,13 @@ class sftp_wrapper(object):
         'arcfour128': {'class': ARC4, 'mode': None, 'block-size': 8, 'key-size': 16},
         'arcfour256': {'class': ARC4, 'mode': None, 'block-size': 8, 'key-size': 32},
     }
+    _cipher_info.update(aead_cipher_info)
 
     _mac_info = {
+        'hmac-sha2-256-etm@openssh.com': {'class': sha256, 'size': 32, 'etm': True},
+        'hmac-sha2-512-etm@openssh.com': {'class': sha512, 'size': 64, 'etm': True},
+        'hmac-sha2-256': {'class': sha256, 'size': 32},
+        'hmac-sha2-512': {'class': sha512, 'size': 64},
         'hmac-sha1': {'class': sha1, 'size': 20},
         'hmac-sha1-96': {'class': sha1, 'size': 12},
         'hmac-md5': {'class': md5, 'size': 16},
@@ -112,15 +124,17 @@ class sftp_wrapper(object):
         'ssh-dss': DSSKey,
         'ecdsa-sha2-nistp256': ECDSAKey,
     }
+    _key_info.update(host_key_info)
 
     _kex_info = {
-        'diffie-hellman-group1-sha1': KexGroup1,
-        'diffie-hellman-group14-sha1': KexGroup14,
-        'diffie-hellman-group-exchange-sha1': KexGex,
+        'diffie-hellman-group1-sha1': solt_kex_group1,
+        'diffie-hellman-group14-sha1': solt_kex_group14,
+        'diffie-hellman-group-exchange-sha1': solt_kex_gex,
         'gss-group1-sha1-toWM5Slw5Ew8Mqkay+al2g==': KexGSSGroup1,
         'gss-group14-sha1-toWM5Slw5Ew8Mqkay+al2g==': KexGSSGroup14,
         'gss-gex-sha1-toWM5Slw5Ew8Mqkay+al2g==': KexGSSGex
     }
+    _kex_info.update(ecdh_kex_info)
 
     _compression_info = {
         # zlib@openssh.com is just zlib, but only turned on after a successful
@@ -197,15 +211,15 @@ class sftp_wrapper(object):
         self.sock = sock
         # Python < 2.3 doesn't have the settimeout method - RogerB
         try:
-            # we set the timeout so we can check self.active periodically to
-            # see if we should bail.  socket.timeout exception is never
-            # propagated.
-            self.sock.settimeout(0.1)
+            # reads block on the gevent hub until data arrives, `close` wakes
+            # them up by closing the socket so there is no need to poll
+            # self.active with a timeout.
+            self.sock.settimeout(None)
         except AttributeError:
             pass
 
         # negotiated crypto parameters
-        self.packetizer = Packetizer(sock)
+        self.packetizer = solt_packetizer(sock)
         self.local_version = 'SSH-' + self._PROTO_ID + '-' + self._CLIENT_ID
         self.remote_version = ''
         self.local_cipher = self.remote_cipher = ''
@@ -233,6 +247,9 @@ class sftp_wrapper(object):
 
         # state used during negotiation
         self.kex_engine = None
+        self.kex_algorithm = None
+        self.kex_started = None
+        self.ext_info = False
         self.H = None
         self.K = None
 
@@ -400,12 +417,16 @@ class sftp_wrapper(object):
         SSH2 negotiation, so that the client can trust that we are who we say
         we are.  Because this is used for signing, the key must contain private
         key info, not just the public half.  Only one key of each type (RSA or
-        DSS) is kept.
+        DSS) is kept. An RSA key is also offered as rsa-sha2-256 and
+        rsa-sha2-512.
 
         :param .PKey key:
             the host key to add, usually an `.RSAKey` or `.DSSKey`.
         """
         self.server_key_dict[key.get_name()] = key
+        if key.get_name() == 'ssh-rsa':
+            for sha2_key in rsa_sha2_keys(key):
+                self.server_key_dict[sha2_key.get_name()] = sha2_key
 
     def get_server_key(self):
         """
@@ -477,7 +498,9 @@ class sftp_wrapper(object):
             return
         for chan in list(self._channels.values()):
             chan._unlink()
-        self.sock.close()
+        # closing the socket wakes up the greenlet blocked reading on it,
+        # the packetizer is flagged closed first so it turns into an EOF
+        self.packetizer.close()
 
     def get_remote_server_key(self):
         """
@@ -771,6 +794,8 @@ class sftp_wrapper(object):
             seconds to wait before sending a keepalive packet (or
             0 to disable keepalives).
         """
+        # the packetizer only checks the keepalive when a read times out
+        self.sock.settimeout(interval or None)
         self.packetizer.set_keepalive(interval,
                                       lambda x=weakref.proxy(self): x.global_request('keepalive@lag.net', wait=False))
 
@@ -1277,24 +1302,31 @@ class sftp_wrapper(object):
     def _send_user_message(self, data):
         """
         send a message, but block if we're in key negotiation.  this is used
-        for user-initiated requests.
+        for user-initiated requests.  the writers sleep on `clear_to_send`
+        and are all woken up at once when `_parse_newkeys` sets it (or when
+        the session dies).
         """
-        start = time.time()
+        deadline = time.time() + self.clear_to_send_timeout
         while True:
-            self.clear_to_send.wait(0.1)
+            if not self.clear_to_send.wait(max(0, deadline - time.time())):
+                raise SSHException('Key-exchange timed out waiting for key negotiation')
             if not self.active:
                 self._log(DEBUG, 'Dropping user packet because connection is dead.')
                 return
             self.clear_to_send_lock.acquire()
             if self.clear_to_send.is_set():
                 break
+            # another key exchange started while we queued for the lock
             self.clear_to_send_lock.release()
-            if time.time() > start + self.clear_to_send_timeout:
-                raise SSHException('Key-exchange timed out waiting for key negotiation')
         try:
             self._send_message(data)
+            # the read loop no longer wakes up periodically to notice that
+            # the outbound traffic requires a rekey, so start it from here
+            rekey = self.packetizer.need_rekey() and not self.in_kex
         finally:
             self.clear_to_send_lock.release()
+        if rekey:
+            self._send_kex_init()
 
     def _set_K_H(self, k, h):
         """used by a kex object to set the K (root key) and H (exchange hash)"""
@@ -1317,18 +1349,19 @@ class sftp_wrapper(object):
 
     def _compute_key(self, id, nbytes):
         """id is 'A' - 'F' for the various keys used by ssh"""
+        hash_algo = getattr(self.kex_engine, 'hash_algo', None) or sha1
         m = Message()
         m.add_mpint(self.K)
         m.add_bytes(self.H)
         m.add_byte(b(id))
         m.add_bytes(self.session_id)
-        out = sofar = sha1(m.asbytes()).digest()
+        out = sofar = hash_algo(m.asbytes()).digest()
         while len(out) < nbytes:
             m = Message()
             m.add_mpint(self.K)
             m.add_bytes(self.H)
             m.add_bytes(sofar)
-            digest = sha1(m.asbytes()).digest()
+            digest = hash_algo(m.asbytes()).digest()
             out += digest
             sofar += digest
         return out[:nbytes]
@@ -1482,6 +1515,9 @@ class sftp_wrapper(object):
             if self.active:
                 self.active = False
                 self.packetizer.close()
+                # wake up the writers waiting for a key exchange, they will
+                # see the session is dead and drop their packets
+                self.clear_to_send.set()
                 if self.completion_event is not None:
                     self.completion_event.set()
                 if self.auth_handler is not None:
@@ -1527,7 +1563,9 @@ class sftp_wrapper(object):
             else:
                 timeout = 2
             try:
-                buf = self.packetizer.readline(timeout)
+                # the socket has no timeout, bound the wait on the hub instead
+                with Timeout(timeout, socket.timeout()):
+                    buf = self.packetizer.readline(timeout)
             except ProxyCommandFailure:
                 raise
             except Exception as e:
@@ -1560,12 +1598,13 @@ class sftp_wrapper(object):
         announce to the other side that we'd like to negotiate keys, and what
         kind of key negotiation we support.
         """
-        self.clear_to_send_lock.acquire()
-        try:
-            self.clear_to_send.clear()
-        finally:
-            self.clear_to_send_lock.release()
+        # the read loop and the writers can all start a rekey, only the
+        # first one sends a KEXINIT. in_kex and local_kex_init are set
+        # before anything yields, the lock below is not fair.
+        if self.in_kex and self.local_kex_init is not None:
+            return
         self.in_kex = True
+        self.kex_started = time.time()
         if self.server_mode:
             if (self._modulus_pack is None) and ('diffie-hellman-group-exchange-sha1' in self._preferred_kex):
                 # can't do group-exchange if we don't have a pack of potential primes
@@ -1594,6 +1633,11 @@ class sftp_wrapper(object):
         m.add_int(0)
         # save a copy for later (needed to compute a hash)
         self.local_kex_init = m.asbytes()
+        self.clear_to_send_lock.acquire()
+        try:
+            self.clear_to_send.clear()
+        finally:
+            self.clear_to_send_lock.release()
         self._send_message(m)
 
     def _parse_kex_init(self, m):
@@ -1631,6 +1675,11 @@ class sftp_wrapper(object):
         if len(agreed_kex) == 0:
             raise SSHException('Incompatible ssh peer (no acceptable kex algorithm)')
         self.kex_engine = self._kex_info[agreed_kex[0]](self)
+        self.kex_algorithm = agreed_kex[0]
+        if self.server_mode and self.session_id is None:
+            # the client asks for SSH_MSG_EXT_INFO, without server-sig-algs
+            # openssh only signs the user auth with ssh-rsa (RFC 8308)
+            self.ext_info = 'ext-info-c' in kex_algo_list
 
         if self.server_mode:
             available_server_keys = list(filter(list(self.server_key_dict.keys()).__contains__,
@@ -1666,6 +1715,11 @@ class sftp_wrapper(object):
         else:
             agreed_local_macs = list(filter(client_mac_algo_list.__contains__, self._preferred_macs))
             agreed_remote_macs = list(filter(server_mac_algo_list.__contains__, self._preferred_macs))
+        # the AEAD ciphers authenticate the packets themselves
+        if self._cipher_info[self.local_cipher].get('aead'):
+            agreed_local_macs = [None]
+        if self._cipher_info[self.remote_cipher].get('aead'):
+            agreed_remote_macs = [None]
         if (len(agreed_local_macs) == 0) or (len(agreed_remote_macs) == 0):
             raise SSHException('Incompatible ssh server (no acceptable macs)')
         self.local_mac = agreed_local_macs[0]
@@ -1695,6 +1749,23 @@ class sftp_wrapper(object):
 
     def _activate_inbound(self):
         """switch on newly negotiated encryption parameters for inbound traffic"""
+        cipher_info = self._cipher_info[self.remote_cipher]
+        if cipher_info.get('aead'):
+            if self.server_mode:
+                IV_in = self._compute_key('A', cipher_info['iv-size'])
+                key_in = self._compute_key('C', cipher_info['key-size'])
+            else:
+                IV_in = self._compute_key('B', cipher_info['iv-size'])
+                key_in = self._compute_key('D', cipher_info['key-size'])
+            self.packetizer.set_inbound_aead(cipher_info['class'](key_in, IV_in))
+        else:
+            self._activate_inbound_cipher()
+        compress_in = self._compression_info[self.remote_compression][1]
+        if (compress_in is not None) and ((self.remote_compression != 'zlib@openssh.com') or self.authenticated):
+            self._log(DEBUG, 'Switching on inbound compression ...')
+            self.packetizer.set_inbound_compressor(compress_in())
+
+    def _activate_inbound_cipher(self):
         block_size = self._cipher_info[self.remote_cipher]['block-size']
         if self.server_mode:
             IV_in = self._compute_key('A', block_size)
@@ -1711,17 +1782,43 @@ class sftp_wrapper(object):
             mac_key = self._compute_key('E', mac_engine().digest_size)
         else:
             mac_key = self._compute_key('F', mac_engine().digest_size)
-        self.packetizer.set_inbound_cipher(engine, block_size, mac_engine, mac_size, mac_key)
-        compress_in = self._compression_info[self.remote_compression][1]
-        if (compress_in is not None) and ((self.remote_compression != 'zlib@openssh.com') or self.authenticated):
-            self._log(DEBUG, 'Switching on inbound compression ...')
-            self.packetizer.set_inbound_compressor(compress_in())
+        etm = self._mac_info[self.remote_mac].get('etm', False)
+        self.packetizer.set_inbound_cipher(engine, block_size, mac_engine, mac_size, mac_key, etm)
 
     def _activate_outbound(self):
         """switch on newly negotiated encryption parameters for outbound traffic"""
         m = Message()
         m.add_byte(cMSG_NEWKEYS)
         self._send_message(m)
+        cipher_info = self._cipher_info[self.local_cipher]
+        if cipher_info.get('aead'):
+            if self.server_mode:
+                IV_out = self._compute_key('B', cipher_info['iv-size'])
+                key_out = self._compute_key('D', cipher_info['key-size'])
+            else:
+                IV_out = self._compute_key('A', cipher_info['iv-size'])
+                key_out = self._compute_key('C', cipher_info['key-size'])
+            self.packetizer.set_outbound_aead(cipher_info['class'](key_out, IV_out))
+        else:
+            self._activate_outbound_cipher()
+        compress_out = self._compression_info[self.local_compression][0]
+        if (compress_out is not None) and ((self.local_compression != 'zlib@openssh.com') or self.authenticated):
+            self._log(DEBUG, 'Switching on outbound compression ...')
+            self.packetizer.set_outbound_compressor(compress_out())
+        if self.ext_info:
+            self.ext_info = False
+            m = Message()
+            m.add_byte(cMSG_EXT_INFO)
+            m.add_int(1)
+            m.add_string('server-sig-algs')
+            m.add_string(','.join(self._preferred_keys))
+            self._send_message(m)
+        if not self.packetizer.need_rekey():
+            self.in_kex = False
+        # we always expect to receive NEWKEYS now
+        self._expect_packet(MSG_NEWKEYS)
+
+    def _activate_outbound_cipher(self):
         block_size = self._cipher_info[self.local_cipher]['block-size']
         if self.server_mode:
             IV_out = self._compute_key('B', block_size)
@@ -1739,15 +1836,8 @@ class sftp_wrapper(object):
         else:
             mac_key = self._compute_key('E', mac_engine().digest_size)
         sdctr = self.local_cipher.endswith('-ctr')
-        self.packetizer.set_outbound_cipher(engine, block_size, mac_engine, mac_size, mac_key, sdctr)
-        compress_out = self._compression_info[self.local_compression][0]
-        if (compress_out is not None) and ((self.local_compression != 'zlib@openssh.com') or self.authenticated):
-            self._log(DEBUG, 'Switching on outbound compression ...')
-            self.packetizer.set_outbound_compressor(compress_out())
-        if not self.packetizer.need_rekey():
-            self.in_kex = False
-        # we always expect to receive NEWKEYS now
-        self._expect_packet(MSG_NEWKEYS)
+        etm = self._mac_info[self.local_mac].get('etm', False)
+        self.packetizer.set_outbound_cipher(engine, block_size, mac_engine, mac_size, mac_key, sdctr, etm)
 
     def _auth_trigger(self):
         self.authenticated = True
@@ -1764,10 +1854,14 @@ class sftp_wrapper(object):
     def _parse_newkeys(self, m):
         self._log(DEBUG, 'Switch to new keys ...')
         self._activate_inbound()
+        # from our KEXINIT to the new keys, per kex algorithm
+        stats.timing('kex.%s' % self.kex_algorithm, time.time() - self.kex_started)
         # can also free a bunch of stuff here
         self.local_kex_init = self.remote_kex_init = None
         self.K = None
         self.kex_engine = None
+        self.kex_algorithm = None
+        self.kex_started = None
         if self.server_mode and (self.auth_handler is None):
             # create auth handler for server mode
             self.auth_handler = AuthHandler(self)